@@ -0,0 +1,315 @@
+# module: benchmark.py
+# Benchmarks of the dynamixel layer and the Reflex_SF hand against simulated MX-28 servos (mx28_sim).
+# The servos run in-process, or behind a pseudo terminal with --pty so that the real pyserial path is measured.
+# Measures latency percentiles per instruction, CPU cost of encoding and decoding packets, reads and writes per
+# second per servo and whole-hand gesture times. Results are written as JSON; --compare reports the metrics that
+# got slower than a saved run so regressions can be caught. Reads through the bus scheduler are timed against
+# direct reads, and a scheduler that adds more than --scheduler-overhead to them fails the run.
+#
+#   python benchmark.py --baudrate 1000000 --output new.json --compare old.json
+
+import json
+import logging
+import optparse
+import os
+import select
+import sys
+import threading
+import time
+
+import dynamixel
+import mx28_sim
+import reflex_sf
+
+# sections of the results compared with a baseline - the others (framing, instrumentation) are counts that grow
+# with the speed of the build, since the throughput runs last a fixed time
+COMPARED_SECTIONS = ["latency_us", "scheduler_latency_us", "cpu_ns", "gestures_s", "throughput"]
+# runs that differ in these are not compared
+META_KEYS = ["baudrate", "transport", "model_timing", "iterations"]
+# microseconds the bus scheduler may add to the median and p90 read
+SCHEDULER_OVERHEAD_US = 2000.0
+# seconds between the reads sent to the scheduler, long enough for it to go idle
+SCHEDULER_IDLE_GAP = 0.02
+
+
+def percentiles(samples):
+    ''' {"mean", "p50", "p90", "p99", "max"} of samples, in microseconds
+    '''
+    s = sorted(samples)
+    n = len(s)
+    def at(q):
+        return s[min(int(q * n), n - 1)] * 1e6
+    return {"mean": sum(s) / n * 1e6, "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": s[-1] * 1e6}
+
+
+def time_calls(f, iterations):
+    samples = []
+    for k in range(iterations):
+        t = time.time()
+        f()
+        samples.append(time.time() - t)
+    return samples
+
+
+class Pty_Servo_Server():
+    ''' Serves a Simulated_Bus on a pseudo terminal; the slave name can be opened with pyserial
+    '''
+    def __init__(self, bus):
+        self.bus = bus
+        self.master, slave = os.openpty()
+        self.name = os.ttyname(slave)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='Pty_Servo_Server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def _run(self):
+        while self.running:
+            readable, w, x = select.select([self.master], [], [], 0.0002)
+            if readable:
+                self.bus.write(os.read(self.master, 1024))
+            n = self.bus.inWaiting()
+            if n > 0:
+                os.write(self.master, self.bus.read(n))
+
+
+def bench_latency(palm, iterations):
+    dyn = palm.dyn
+    servo = palm.finger[1].servo
+    ids = [1,2,3,4]
+    blocks = [(i, dynamixel.STATUS_BLOCK_ADDRESS, dynamixel.STATUS_BLOCK_LENGTH) for i in ids]
+    goal = servo.read_encoder()
+    # every servo is sent to where it already is
+    goals = {}
+    for i in ids:
+        p = palm.finger[i].servo.read_encoder()
+        goals[i] = [p % 256, p / 256]
+    results = {
+        "ping": time_calls(lambda: dyn.ping(servo.servo_id, 1.0), iterations),
+        "read_position": time_calls(lambda: servo.read_address(0x24, 2), iterations),
+        "read_status_block": time_calls(servo.read_status_block, iterations),
+        "write_goal": time_calls(lambda: servo.set_goal_position(goal), iterations),
+        "sync_write_goals": time_calls(lambda: dyn.sync_write(0x1e, goals), iterations),
+        "bulk_read_status": time_calls(lambda: dyn.bulk_read(blocks), iterations),
+    }
+    servo.set_no_ack_writes(True)
+    results["write_goal_no_ack"] = time_calls(lambda: servo.set_goal_position(goal), iterations)
+    servo.set_no_ack_writes(False)
+    return dict([(k, percentiles(v)) for k, v in results.items()])
+
+
+def bench_scheduler(palm, iterations):
+    ''' latency of the same read sent directly and through the bus scheduler (started for the run), and of
+        one Bulk Read of the hand through it
+    '''
+    dyn = palm.dyn
+    servo = palm.finger[1].servo
+    results = {"direct_read_position": time_calls(lambda: servo.read_address(0x24, 2), iterations)}
+    dyn.start_scheduler()
+    try:
+        # a pause between reads so that each one finds the scheduler idle, as a command from the joystick does
+        def idle_read():
+            time.sleep(SCHEDULER_IDLE_GAP)
+            t = time.time()
+            servo.read_address(0x24, 2)
+            return time.time() - t
+        results["scheduled_read_position"] = [idle_read() for k in range(iterations)]
+        results["scheduled_positions"] = time_calls(palm.finger_positions, iterations)
+    finally:
+        dyn.stop_scheduler()
+    return dict([(k, percentiles(v)) for k, v in results.items()])
+
+
+def check_scheduler(results, overhead_us):
+    ''' returns [(metric, direct, scheduled)] if reads through the scheduler are slower than direct ones by more
+        than overhead_us at the median or at p90
+    '''
+    latency = results["scheduler_latency_us"]
+    slow = []
+    for q in ("p50", "p90"):
+        direct = latency["direct_read_position"][q]
+        scheduled = latency["scheduled_read_position"][q]
+        if scheduled - direct > overhead_us:
+            slow.append(("scheduler_latency_us.scheduled_read_position." + q, direct, scheduled))
+    return slow
+
+
+def bench_cpu(iterations):
+    ''' nanoseconds per call of the packet encoder and the status packet decoder
+    '''
+    encoder = dynamixel.Instruction_Packet_Encoder()
+    framer = dynamixel.Status_Packet_Framer()
+    status = '\xff\xff\x01\x0d\x00' + ''.join([chr(v) for v in range(11)])
+    status += chr((~sum([ord(c) for c in status[2:]])) % 256)
+    blocks = [(i, 0x24, 11) for i in [1,2,3,4]]
+    goals = dict([(i, [0x10, 0x36]) for i in [1,2,3,4]])
+    block = range(11)
+    def decode():
+        framer.feed(status)
+        framer.next_packet()
+    calls = {
+        "encode_read": lambda: encoder.read(1, 0x24, 2),
+        "encode_write": lambda: encoder.write(1, 0x1e, [0x10, 0x36]),
+        "encode_instruction": lambda: encoder.instruction(1, [dynamixel.WRITE_DATA, 0x1e, 0x10, 0x36]),
+        "encode_sync_write": lambda: encoder.sync_write(0x1e, goals),
+        "encode_bulk_read": lambda: encoder.bulk_read(blocks),
+        "decode_status_packet": decode,
+        "decode_status_block": lambda: dynamixel.decode_status_block(block),
+    }
+    results = {}
+    for name, f in calls.items():
+        t = time.clock()
+        for k in range(iterations):
+            f()
+        results[name] = (time.clock() - t) / iterations * 1e9
+    return results
+
+
+def bench_throughput(servo, seconds):
+    ''' reads and writes per second to one servo
+    '''
+    goal = servo.read_encoder()
+    results = {}
+    for name, f in [("reads_per_second", lambda: servo.read_address(0x24, 2)),
+                    ("writes_per_second", lambda: servo.set_goal_position(goal))]:
+        n = 0
+        t0 = time.time()
+        while time.time() - t0 < seconds:
+            f()
+            n += 1
+        results[name] = n / (time.time() - t0)
+    return results
+
+
+def bench_gestures(palm):
+    ''' seconds taken by whole-hand gestures, starting with the fingers at their start positions
+    '''
+    results = {}
+    palm.send_fingers_to_start_position()
+    for name, f in [("tighten_fingers", palm.tighten_fingers), ("loosen_fingers", palm.loosen_fingers),
+                    ("spread_finger_1_and_2", palm.spread_finger_1_and_2),
+                    ("close_finger_1_and_2", palm.close_finger_1_and_2)]:
+        t = time.time()
+        f()
+        results[name] = time.time() - t
+    palm.tighten_fingers()
+    t = time.time()
+    palm.send_finger_to_start_position(1)
+    results["send_finger_to_start_position"] = time.time() - t
+    palm.tighten_fingers()
+    t = time.time()
+    palm.send_fingers_to_start_position()
+    results["send_fingers_to_start_position"] = time.time() - t
+    return results
+
+
+def meta_differences(results, baseline):
+    ''' [(key, old, new)] of the META_KEYS in which the two runs differ
+    '''
+    old = baseline.get("meta", {})
+    new = results["meta"]
+    return [(key, old.get(key), new.get(key)) for key in META_KEYS if old.get(key) != new.get(key)]
+
+
+def compare(results, baseline, threshold):
+    ''' returns [(metric, old, new)] for every timing in COMPARED_SECTIONS that grew by more than threshold
+        (a ratio) or rate that fell by more than it
+    '''
+    regressions = []
+    def walk(new, old, path):
+        for key in new.keys():
+            if key not in old:
+                continue
+            name = path + [key]
+            if isinstance(new[key], dict):
+                walk(new[key], old[key], name)
+            elif isinstance(new[key], (int, float)) and old[key] > 0:
+                ratio = float(new[key]) / old[key]
+                if key.endswith("per_second"):
+                    ratio = 1.0 / max(ratio, 1e-9)
+                if ratio > threshold:
+                    regressions.append((".".join(name), old[key], new[key]))
+    for section in COMPARED_SECTIONS:
+        if section in results and section in baseline:
+            walk(results[section], baseline[section], [section])
+    return regressions
+
+
+def run(options):
+    logging.getLogger('MyLogger').addHandler(logging.NullHandler())
+    bus = mx28_sim.reflex_sf_bus(options.baudrate, model_timing=not options.no_timing)
+    server = None
+    if options.pty:
+        server = Pty_Servo_Server(bus)
+        palm = reflex_sf.reflex_sf(server.name, options.baudrate)
+    else:
+        palm = reflex_sf.reflex_sf('simulated', options.baudrate, bus)
+    servo = palm.finger[1].servo
+    if options.instrument:
+        palm.dyn.enable_instrumentation()
+    results = {
+        "meta": {"python": sys.version.split()[0], "baudrate": options.baudrate,
+                 "transport": "pty" if options.pty else "in-process", "model_timing": not options.no_timing,
+                 "iterations": options.iterations, "time": time.strftime('%Y-%m-%d %H:%M:%S')},
+        "latency_us": bench_latency(palm, options.iterations),
+        "scheduler_latency_us": bench_scheduler(palm, options.iterations),
+        "cpu_ns": bench_cpu(options.iterations * 10),
+        "throughput": bench_throughput(servo, options.seconds),
+        "gestures_s": bench_gestures(palm),
+        "framing": palm.dyn.framing_stats(),
+    }
+    if options.instrument:
+        results["instrumentation"] = palm.dyn.instrumentation_snapshot()
+    if server is not None:
+        server.stop()
+    return results
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--baudrate', type='int', default=57600, help='bus baud rate [default: %default]')
+    parser.add_option('--pty', action='store_true', default=False,
+                      help='serve the simulated servos on a pseudo terminal and use pyserial')
+    parser.add_option('--no-timing', action='store_true', default=False,
+                      help='do not model byte times and return delays (measures Python overhead only)')
+    parser.add_option('--iterations', type='int', default=200, help='calls per latency measurement [default: %default]')
+    parser.add_option('--seconds', type='float', default=1.0, help='duration of each throughput run [default: %default]')
+    parser.add_option('--instrument', action='store_true', default=False,
+                      help='time the phases of every transaction and add the histograms to the results')
+    parser.add_option('--scheduler-overhead', type='float', default=SCHEDULER_OVERHEAD_US,
+                      help='microseconds the bus scheduler may add to a read [default: %default]')
+    parser.add_option('--output', help='write the JSON results to this file as well as stdout')
+    parser.add_option('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_option('--threshold', type='float', default=1.2,
+                      help='ratio above which a metric counts as a regression [default: %default]')
+    (options, args) = parser.parse_args()
+
+    results = run(options)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print text
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text)
+    failed = False
+    for name, direct, scheduled in check_scheduler(results, options.scheduler_overhead):
+        print >> sys.stderr, 'Scheduler too slow: {} {:.0f} us direct -> {:.0f} us'.format(name, direct, scheduled)
+        failed = True
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        differences = meta_differences(results, baseline)
+        for key, old, new in differences:
+            print >> sys.stderr, 'Not comparable: {} was {} in {}, is {}'.format(key, old, options.compare, new)
+        if len(differences) > 0:
+            sys.exit(2)
+        regressions = compare(results, baseline, options.threshold)
+        for name, old, new in regressions:
+            print >> sys.stderr, 'Regression: {} {} -> {}'.format(name, old, new)
+        if len(regressions) > 0:
+            failed = True
+    if failed:
+        sys.exit(1)
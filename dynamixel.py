@@ -37,6 +37,8 @@
 import serial
 import time
 import thread
+import threading
+import collections
 import sys, optparse
 import math
 import string
@@ -44,13 +46,815 @@ import string
 import pwd
 import os
 import grp
+import struct
+import json
+import logging
+
+BROADCAST_ID = 0xFE
+PING = 0x01
+READ_DATA = 0x02
+WRITE_DATA = 0x03
+SYNC_WRITE = 0x83
+BULK_READ = 0x92
+
+# Present position (0x24) up to the moving flag (0x2E) is one contiguous block of the MX-28 control table
+STATUS_BLOCK_ADDRESS = 0x24
+STATUS_BLOCK_LENGTH = 11
+
+# The MX-28 control table ends at 0x49 so no status packet can carry more than 74 parameters
+MAX_STATUS_LENGTH = 76
+
+# MX-28 moving speed is in units of 0.114 rpm and 0 means no speed control (about 55 rpm at 12V)
+RPM_PER_SPEED_UNIT = 0.114
+MAX_RPM = 55.0
+TICKS_PER_REV = 4096
+# Polling of the moving flag once the estimated move time is nearly over
+POLL_MIN = 0.005
+POLL_MAX = 0.1
+MOTION_TIMEOUT_MARGIN = 2.0
+
+# Baud Rate register (0x04) values. The USB2Dynamixel goes up to 3 Mbps.
+BAUD_RATES = { 3000000: 252, 2500000: 251, 2250000: 250, 1000000: 1, 500000: 3, 400000: 4, 250000: 7,
+               200000: 9, 115200: 16, 57600: 34, 19200: 103, 9600: 207 }
+# Fastest first so a scan finds the bus at the best rate it is already set to
+BAUD_SEARCH_ORDER = sorted( BAUD_RATES.keys(), reverse=True )
+# Seconds to wait for a ping reply. The FTDI chip of the USB2Dynamixel holds received bytes for up to its
+# latency timer (16 ms by default) and the servo answers after its return delay (up to 0.5 ms), so this is
+# well above both. Discovery pings one servo per baud rate, so a missing answer costs little.
+PING_TIMEOUT = 0.08
+# Once a status packet has started, the rest of it is on the wire back to back. It may come this much
+# later than its byte time (USB latency) before the start is taken to be noise that looked like a header.
+PACKET_GAP_TIMEOUT = 0.02
+
+# Priorities of the bus scheduler, most urgent first
+SAFETY = 0
+GOAL = 1
+READ = 2
+TELEMETRY = 3
+PRIORITY_NAMES = [ "safety", "goal", "read", "telemetry" ]
+# Writes to torque enable (0x18) and torque limit (0x22) go ahead of everything else
+SAFETY_ADDRESSES = ( 0x18, 0x22 )
+
+# 0x00 to 0x17 is the EEPROM area of the MX-28 control table. It only changes when we write it.
+EEPROM_SIZE = 0x18
+
+
+def decode_status_block(data):
+    ''' decodes the bytes read from 0x24 to 0x2E into a dictionary.
+        speed is in rpm (negative when turning clockwise), load and load_direction are as
+        returned by read_and_convert_raw_load, voltage in Volts and temperature in Celcius.
+    '''
+    speed = data[2] + data[3] * 256
+    rpm = (speed & 0x3FF) * 0.114
+    if speed & 0x400:
+        rpm = -rpm
+    raw_load = data[4] + data[5] * 256
+    if raw_load <= 1023:
+        load, load_direction = raw_load, "Counter Clockwise"
+    else:
+        load, load_direction = raw_load - 1023, "Clockwise"
+    return {"position": data[0] + data[1] * 256, "speed": rpm, "raw_load": raw_load, "load": load,
+            "load_direction": load_direction, "voltage": data[6] / 10., "temperature": data[7],
+            "moving": data[10] != 0}
+
+
+class Motion_Schedule():
+    ''' when to check on servos that are moving - shared by wait_for_motion and reflex_async.
+        estimates = {key: estimated move time in seconds}
+        Each key is left alone for 0.8 of its estimate, then checked at intervals that start at POLL_MIN
+        and double up to POLL_MAX. timeout defaults to twice the longest estimate plus MOTION_TIMEOUT_MARGIN.
+    '''
+    def __init__(self, estimates, timeout=None):
+        self.t0 = time.time()
+        self.due = {}
+        for key in estimates.keys():
+            self.due[key] = self.t0 + 0.8 * estimates[key]
+        if timeout is None:
+            timeout = 2 * max( estimates.values() + [0.0] ) + MOTION_TIMEOUT_MARGIN
+        self.timeout = timeout
+        self.interval = POLL_MIN
+        self.arrival = {}
+
+    def waiting(self):
+        ''' keys still to be checked, or [] once all have arrived or the timeout has passed
+        '''
+        if time.time() - self.t0 > self.timeout:
+            return []
+        return self.due.keys()
+
+    def ready(self):
+        ''' keys due to be checked now
+        '''
+        now = time.time()
+        return [key for key in self.due.keys() if self.due[key] <= now]
+
+    def arrived(self, key):
+        self.arrival[key] = time.time() - self.t0
+        del self.due[key]
+
+    def pause(self):
+        ''' seconds to wait before the next check: until the first key is due, then the polling interval
+        '''
+        now = time.time()
+        first_due = min( self.due.values() )
+        if first_due > now:
+            return min( first_due - now, self.t0 + self.timeout - now )
+        pause = self.interval
+        self.interval = min( self.interval * 2, POLL_MAX )
+        return pause
+
+
+def wait_for_motion(moves, timeout=None, cancel=None, tolerance=None):
+    ''' waits for several servos to stop moving without flooding the bus with is_moving reads.
+        moves = [(servo, start, goal) ...] - encoder positions used to estimate when each servo arrives.
+                start or goal may be None if not known.
+        Each servo is left alone for most of its estimated move time, then its moving flag is polled,
+        quickly at first and slower the longer it takes (see Motion_Schedule).
+        timeout - seconds, defaults to twice the longest estimate plus MOTION_TIMEOUT_MARGIN
+        cancel - optional threading.Event that ends the wait early
+        tolerance - if given, a servo has arrived once it is within tolerance ticks of its goal
+                    rather than when its moving flag clears
+        returns {servo_id: seconds until it was seen stopped}. Servos still moving at the timeout
+        (or when cancelled) are left out.
+    '''
+    estimates = {}
+    servos = {}
+    goals = {}
+    for servo, start, goal in moves:
+        if start is None or goal is None:
+            estimates[servo.servo_id] = 0.0
+        else:
+            estimates[servo.servo_id] = servo.estimate_move_time( start, goal )
+        servos[servo.servo_id] = servo
+        goals[servo.servo_id] = goal
+
+    schedule = Motion_Schedule( estimates, timeout )
+    while len(schedule.waiting()) > 0:
+        for servo_id in schedule.ready():
+            if tolerance is None or goals[servo_id] is None:
+                arrived = not servos[servo_id].is_moving()
+            else:
+                arrived = abs( servos[servo_id].read_encoder() - goals[servo_id] ) <= tolerance
+            if arrived:
+                schedule.arrived( servo_id )
+        if len(schedule.waiting()) == 0:
+            break
+        pause = schedule.pause()
+        if cancel is None:
+            time.sleep( pause )
+        elif cancel.wait( pause ):
+            break
+    return schedule.arrival
+
+
+def discover_bus(device, ids=(1,2,3,4), baudrates=BAUD_SEARCH_ORDER, timeout=PING_TIMEOUT):
+    ''' looks for the servos at each baud rate in turn and leaves the adaptor at the first rate where all
+        of ids answer a ping. Protocol 1.0 servos do not answer a broadcast ping so each id is pinged.
+        returns (baudrate, [ids found]), or (None, []) if no rate has all of them
+    '''
+    for baudrate in baudrates:
+        device.set_baudrate( baudrate )
+        # if the first servo is missing, the bus is not at this rate - no need to try the others
+        if device.ping( ids[0], timeout ) and len(device.scan( ids[1:], timeout )) == len(ids) - 1:
+            return baudrate, list(ids)
+    return None, []
+
+
+def change_bus_baudrate(device, ids, baudrate, timeout=PING_TIMEOUT):
+    ''' moves every servo in ids and the adaptor to baudrate.
+        One Sync Write of the Baud Rate register (0x04) switches all servos together. Servos that do not
+        answer at the new rate are looked for at the old one and written again. If that fails too, all
+        servos are put back to the old rate and RuntimeError is raised.
+    '''
+    if baudrate not in BAUD_RATES:
+        raise RuntimeError('lib_robotis: Baud rate %d not supported by the MX-28\n' % baudrate)
+    old_baudrate = device.baudrate
+    missing = [ i for i in ids if not device.ping( i, timeout ) ]
+    if len(missing) > 0:
+        raise RuntimeError('lib_robotis: Servos %s not found at %d baud\n' % ( missing, old_baudrate ))
+
+    device.sync_write( 0x04, dict([ ( i, [ BAUD_RATES[baudrate] ] ) for i in ids ]) )
+    time.sleep( 0.01 )
+    device.set_baudrate( baudrate )
+    missing = [ i for i in ids if not device.ping( i, timeout ) ]
+    if len(missing) > 0:
+        # the packet was lost for some of them - try again at the old rate
+        if device.instrumentation is not None:
+            device.instrumentation.count( "retries" )
+        device.set_baudrate( old_baudrate )
+        device.sync_write( 0x04, dict([ ( i, [ BAUD_RATES[baudrate] ] ) for i in missing ]) )
+        time.sleep( 0.01 )
+        device.set_baudrate( baudrate )
+        missing = [ i for i in ids if not device.ping( i, timeout ) ]
+    if len(missing) > 0:
+        # put everyone back where they were
+        switched = [ i for i in ids if i not in missing ]
+        device.sync_write( 0x04, dict([ ( i, [ BAUD_RATES[old_baudrate] ] ) for i in switched ]) )
+        time.sleep( 0.01 )
+        device.set_baudrate( old_baudrate )
+        raise RuntimeError('lib_robotis: Servos %s did not change to %d baud, bus left at %d\n'
+                           % ( missing, baudrate, old_baudrate ))
+
+
+class Status_Packet_Framer():
+    ''' Frames status packets out of the bytes read from the bus and verifies their checksum.
+        Bytes are kept in one reusable buffer. The framer looks for the 0xFF 0xFF header, then the
+        id and length, then waits for the rest of the packet. Anything that is not a valid packet
+        is dropped up to the next header. A header that is not followed by the rest of its packet
+        in time is dropped with resync.
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.packets = 0
+        self.checksum_errors = 0
+        self.length_errors = 0
+        self.stray_packets = 0
+        self.discarded_bytes = 0
+        self.timeouts = 0
+        self.resyncs = 0
+
+    def stats(self):
+        return {"packets": self.packets, "checksum_errors": self.checksum_errors,
+                "length_errors": self.length_errors, "stray_packets": self.stray_packets,
+                "discarded_bytes": self.discarded_bytes, "timeouts": self.timeouts, "resyncs": self.resyncs}
+
+    def feed(self, data):
+        self.buffer.extend( data )
+
+    def drop_buffer(self):
+        self.discarded_bytes += len(self.buffer)
+        del self.buffer[:]
+
+    def _discard(self, n):
+        self.discarded_bytes += n
+        del self.buffer[:n]
+
+    def framing(self):
+        ''' True if the buffer starts with the header of a packet that is not complete yet
+        '''
+        return self.buffer[:2] == '\xff\xff'
+
+    def resync(self):
+        ''' drops the header of the packet being framed so that framing starts again at the next header
+            - for line noise that looked like the start of a long packet and would hide the packets behind it.
+            returns True if there was a header to drop
+        '''
+        if not self.framing():
+            return False
+        self.resyncs += 1
+        self._discard( 2 )
+        return True
+
+    def bytes_needed(self):
+        ''' smallest number of bytes that could complete the packet being framed
+        '''
+        buf = self.buffer
+        if len(buf) >= 4 and buf[0] == 0xff and buf[1] == 0xff:
+            return max(buf[3] + 4 - len(buf), 1)
+        return max(6 - len(buf), 1)
+
+    def next_packet(self):
+        ''' returns (servo_id, err, [n1,n2 ...]) for the next complete packet in the buffer or
+            None if more bytes are needed
+        '''
+        buf = self.buffer
+        while True:
+            # Header - everything before the next 0xFF 0xFF is noise
+            start = buf.find( '\xff\xff' )
+            if start < 0:
+                # keep a trailing 0xFF, it may be the first half of a header
+                self._discard( len(buf) - 1 if buf[-1:] == '\xff' else len(buf) )
+                return None
+            if start > 0:
+                self._discard( start )
+            if len(buf) < 4:
+                return None
+            # Id - a third 0xFF means the header starts one byte later
+            if buf[2] == 0xff:
+                self._discard( 1 )
+                continue
+            # Length
+            length = buf[3]
+            if length < 2 or length > MAX_STATUS_LENGTH:
+                self.length_errors += 1
+                self._discard( 2 )
+                continue
+            # Error, parameters and checksum
+            if len(buf) < length + 4:
+                return None
+            if ( ~sum(buf[2:length + 3]) ) % 256 != buf[length + 3]:
+                self.checksum_errors += 1
+                self._discard( 2 )
+                continue
+            packet = ( buf[2], buf[4], list(buf[5:length + 3]) )
+            del buf[:length + 4]
+            self.packets += 1
+            return packet
+
+
+class Instruction_Packet_Encoder():
+    ''' Builds instruction packets as strings ready for write_serial.
+        Packets that never change (ping, read of a register, a repeated bulk read) are built once and
+        cached. Writes start from a cached header whose checksum sum is already known so only the data
+        bytes are added for each packet.
+    '''
+    def __init__(self):
+        self.constant_packets = {}
+        self.write_headers = {}
+
+    def instruction(self, servo_id, instruction):
+        ''' any instruction - instruction = [command, n1, n2 ...]
+        '''
+        body = bytearray([ servo_id, len(instruction) + 1 ]) + bytearray(instruction)
+        body.append( ( ~sum(body) ) % 256 )
+        return '\xff\xff' + str(body)
+
+    def ping(self, servo_id):
+        key = ( PING, servo_id )
+        packet = self.constant_packets.get(key)
+        if packet is None:
+            packet = self.constant_packets[key] = self.instruction( servo_id, [ PING ] )
+        return packet
+
+    def read(self, servo_id, address, nBytes):
+        key = ( READ_DATA, servo_id, address, nBytes )
+        packet = self.constant_packets.get(key)
+        if packet is None:
+            packet = self.constant_packets[key] = self.instruction( servo_id, [ READ_DATA, address, nBytes ] )
+        return packet
+
+    def write(self, servo_id, address, data):
+        key = ( servo_id, address, len(data) )
+        header = self.write_headers.get(key)
+        if header is None:
+            head = struct.pack( 'BBBBBB', 0xff, 0xff, servo_id, len(data) + 3, WRITE_DATA, address )
+            header = self.write_headers[key] = ( head, servo_id + len(data) + 3 + WRITE_DATA + address )
+        data = bytearray(data)
+        return header[0] + str(data) + chr( ( ~(header[1] + sum(data)) ) % 256 )
+
+    def sync_write(self, address, data):
+        ''' data = {servo_id: [n1,n2 ...]} with the same number of bytes for every servo
+        '''
+        ids = sorted(data.keys())
+        nBytes = len(data[ids[0]])
+        params = bytearray([ SYNC_WRITE, address, nBytes ])
+        for i in ids:
+            if len(data[i]) != nBytes:
+                raise RuntimeError('lib_robotis: Sync Write needs the same number of bytes for every servo\n')
+            params.append( i )
+            params.extend( data[i] )
+        return self.instruction( BROADCAST_ID, params )
+
+    def bulk_read(self, requests):
+        ''' requests = [(servo_id, address, nBytes) ...]
+        '''
+        key = ( BULK_READ, tuple(requests) )
+        packet = self.constant_packets.get(key)
+        if packet is None:
+            params = [ BULK_READ, 0x00 ]
+            for servo_id, address, nBytes in requests:
+                params += [ nBytes, servo_id, address ]
+            packet = self.constant_packets[key] = self.instruction( BROADCAST_ID, params )
+        return packet
+
+
+class Bus_Future():
+    ''' Result of a request handed to the Bus_Scheduler
+    '''
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set_result(self, value):
+        self.value = value
+        self.event.set()
+
+    def set_exception(self, error):
+        self.error = error
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        if not self.event.wait( timeout ):
+            raise RuntimeError('lib_robotis: Timed out waiting for the bus scheduler\n')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Bus_Request():
+    ''' kind - 'read' or 'write' of one servo, which the scheduler may batch into Bulk Read / Sync Write,
+               or 'packet' - any packet sent as it is, with the status packets of reply_ids collected
+    '''
+    def __init__(self, priority, kind, packet, servo_id=None, address=None, data=None, nBytes=None, reply_ids=()):
+        self.priority = priority
+        self.kind = kind
+        self.packet = packet
+        self.servo_id = servo_id
+        self.address = address
+        self.data = data
+        self.nBytes = nBytes
+        self.reply_ids = reply_ids
+        self.future = Bus_Future()
+        self.submitted = time.time()
+
+
+class Bus_Scheduler():
+    ''' One thread owns the serial port and drains prioritised queues (SAFETY, GOAL, READ, TELEMETRY).
+        All requests waiting at one priority are served together: writes of the same register of several
+        servos become one Sync Write and reads of different servos one Bulk Read. Requests of the same
+        priority may therefore be served out of order; the last write to a register wins.
+    '''
+    def __init__(self, device, max_batch=16):
+        self.device = device
+        self.max_batch = max_batch
+        self.queues = [ collections.deque() for p in PRIORITY_NAMES ]
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.submitted = [ 0 for p in PRIORITY_NAMES ]
+        self.served = [ 0 for p in PRIORITY_NAMES ]
+        self.batches = [ 0 for p in PRIORITY_NAMES ]
+        self.total_wait = [ 0.0 for p in PRIORITY_NAMES ]
+        self.max_wait = [ 0.0 for p in PRIORITY_NAMES ]
+
+    def stats(self):
+        ''' {priority name: {"depth", "submitted", "served", "batches", "mean_wait", "max_wait"}} - waits in seconds
+        '''
+        stats = {}
+        with self.cond:
+            for p, name in enumerate(PRIORITY_NAMES):
+                stats[name] = {"depth": len(self.queues[p]), "submitted": self.submitted[p], "served": self.served[p],
+                               "batches": self.batches[p], "max_wait": self.max_wait[p],
+                               "mean_wait": self.total_wait[p] / max( self.served[p], 1 )}
+        return stats
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread( target=self._run, name='Bus_Scheduler' )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        ''' serves what is already queued, then stops
+        '''
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, request):
+        future = self.try_submit( request )
+        if future is None:
+            raise RuntimeError('lib_robotis: Bus scheduler is not running\n')
+        return future
+
+    def try_submit(self, request):
+        ''' queues request and returns its Bus_Future, or None if the scheduler has been stopped
+        '''
+        with self.cond:
+            if not self.running:
+                return None
+            self.queues[request.priority].append( request )
+            self.submitted[request.priority] += 1
+            self.cond.notify()
+        return request.future
+
+    def _next_batch(self):
+        with self.cond:
+            while self.running and not any( self.queues ):
+                # no timeout - Python 2 waits with a timeout by polling (sleeps of up to 50 ms), which would
+                # delay the first request after the bus has been idle. submit and stop notify.
+                self.cond.wait()
+            for p in range(len(self.queues)):
+                queue = self.queues[p]
+                if len(queue) > 0:
+                    batch = []
+                    while len(queue) > 0 and len(batch) < self.max_batch:
+                        batch.append( queue.popleft() )
+                    now = time.time()
+                    for request in batch:
+                        wait = now - request.submitted
+                        self.total_wait[p] += wait
+                        self.max_wait[p] = max( self.max_wait[p], wait )
+                    self.served[p] += len(batch)
+                    return batch
+        return None
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            writes = collections.OrderedDict()
+            reads = []
+            for request in batch:
+                if request.kind == 'write':
+                    writes.setdefault( ( request.address, len(request.data) ), [] ).append( request )
+                elif request.kind == 'read':
+                    reads.append( request )
+                else:
+                    self._serve( [ request ], request.packet, request.reply_ids, lambda r, replies: replies )
+            for ( address, nBytes ), group in writes.items():
+                self._serve_writes( address, group )
+            while len(reads) > 0:
+                reads = self._serve_reads( reads )
+
+    def _serve(self, requests, packet, reply_ids, result):
+        self.batches[requests[0].priority] += 1
+        try:
+            replies = self.device.transact( packet, reply_ids )
+        except Exception, e:
+            for request in requests:
+                request.future.set_exception( e )
+            return
+        for request in requests:
+            reply = replies.get( request.servo_id )
+            if reply is not None and reply[1] != 0:
+                request.future.set_exception( RuntimeError('lib_robotis: An error occurred: %d\n' % reply[1]) )
+            else:
+                request.future.set_result( result( request, replies ) )
+
+    def _serve_writes(self, address, group):
+        data = {}
+        for request in group:
+            data[request.servo_id] = request.data
+        if len(data) == 1:
+            # one servo - a plain write so the status packet (if any) still reports errors
+            for request in group:
+                self._serve( [ request ], request.packet, request.reply_ids, lambda r, replies: [] )
+        else:
+            self._serve( group, self.device.encoder.sync_write( address, data ), (), lambda r, replies: [] )
+
+    def _serve_reads(self, reads):
+        ''' one Bulk Read of the first read of each servo; returns the reads left for the next round
+        '''
+        bulk = []
+        left = []
+        ids = set()
+        for request in reads:
+            if request.servo_id in ids:
+                left.append( request )
+            else:
+                ids.add( request.servo_id )
+                bulk.append( request )
+        if len(bulk) == 1:
+            packet = bulk[0].packet
+        else:
+            packet = self.device.encoder.bulk_read( [ ( r.servo_id, r.address, r.nBytes ) for r in bulk ] )
+        self._serve( bulk, packet, [ r.servo_id for r in bulk ], lambda r, replies: replies[r.servo_id][0] )
+        return left
+
+
+INSTRUCTION_NAMES = { PING: "ping", READ_DATA: "read", WRITE_DATA: "write", SYNC_WRITE: "sync_write",
+                      BULK_READ: "bulk_read" }
+
+
+class Latency_Histogram():
+    ''' Counts of durations in power of two microsecond buckets - bucket k holds durations below 2**k us
+    '''
+    BUCKETS = 24 # the last bucket holds everything from 4 s up
+
+    def __init__(self):
+        self.counts = [ 0 ] * self.BUCKETS
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = int( seconds * 1e6 )
+        self.counts[ min( us.bit_length(), self.BUCKETS - 1 ) ] += 1
+        self.n += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        ''' upper bound (us) of the bucket holding the q quantile
+        '''
+        rank = q * self.n
+        seen = 0
+        for k, count in enumerate(self.counts):
+            seen += count
+            if count > 0 and seen >= rank:
+                return 2 ** k
+        return 0
+
+    def snapshot(self):
+        ''' {"count", "mean_us", "p50_us", "p99_us", "max_us", "buckets": {upper bound us: count}}
+        '''
+        return {"count": self.n, "mean_us": self.total / max( self.n, 1 ) * 1e6,
+                "p50_us": self.percentile( 0.5 ), "p99_us": self.percentile( 0.99 ), "max_us": self.max * 1e6,
+                "buckets": dict([ ( 2 ** k, c ) for k, c in enumerate(self.counts) if c > 0 ])}
+
+
+class Bus_Instrumentation():
+    ''' Where the time of each transaction goes, per servo, address and instruction:
+            lock_wait - waiting for the bus mutex (contention with other threads)
+            write - writing the instruction packet to the serial port
+            reply_wait - reading and framing the status packets
+            overhead - the rest of the time since the call into Robotis_Servo (cache lookup, encoding ...)
+            total
+        and counters of timeouts, status packets with the error byte set and retries.
+        Off unless USB2Dynamixel_Device.enable_instrumentation is called; it then costs a few time.time()
+        calls and one short lock per transaction.
+        Scheduler queue waits are not counted here - see USB2Dynamixel_Device.scheduler_stats.
+    '''
+    PHASES = ( "lock_wait", "write", "reply_wait", "overhead", "total" )
+
+    def __init__(self):
+        self.lock = thread.allocate_lock()
+        self.dump_thread = None
+        self.dump_stop = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {"transactions": 0, "timeouts": 0, "error_bytes": 0, "retries": 0}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def record(self, packet, started, acquiring, locked, written, replied, finished):
+        ''' times from time.time() at each step of one transaction of packet
+        '''
+        command = ord(packet[4])
+        if command in ( READ_DATA, WRITE_DATA, SYNC_WRITE ):
+            address = ord(packet[5])
+        else:
+            address = None
+        key = ( ord(packet[2]), address, command )
+        lock_wait = locked - acquiring
+        write = written - locked
+        reply_wait = replied - written
+        total = finished - started
+        with self.lock:
+            phases = self.histograms.get( key )
+            if phases is None:
+                phases = [ Latency_Histogram() for p in self.PHASES ]
+                self.histograms[key] = phases
+            phases[0].add( lock_wait )
+            phases[1].add( write )
+            phases[2].add( reply_wait )
+            phases[3].add( total - lock_wait - write - reply_wait )
+            phases[4].add( total )
+            self.counters["transactions"] += 1
+
+    def snapshot(self, reset=False):
+        ''' {"counters": {...}, "transactions": {"<servo id> <address> <instruction>": {phase: histogram}}}
+            The servo id of Sync Write and Bulk Read is the broadcast id (254), address is "-" if there is none.
+        '''
+        with self.lock:
+            histograms = self.histograms
+            counters = dict(self.counters)
+            if reset:
+                self.histograms = {}
+                self.counters = dict([ ( name, 0 ) for name in counters.keys() ])
+            transactions = {}
+            for ( servo_id, address, command ), phases in histograms.items():
+                if address is None:
+                    name = '%d - %s' % ( servo_id, INSTRUCTION_NAMES.get( command, command ) )
+                else:
+                    name = '%d 0x%02x %s' % ( servo_id, address, INSTRUCTION_NAMES.get( command, command ) )
+                transactions[name] = dict([ ( p, h.snapshot() ) for p, h in zip( self.PHASES, phases ) ])
+        return {"counters": counters, "transactions": transactions}
+
+    def start_dump(self, period, logger=None):
+        ''' logs the snapshot as JSON every period seconds, and starts again from zero each time
+        '''
+        if logger is None:
+            logger = logging.getLogger('MyLogger')
+        self.stop_dump()
+        self.dump_stop.clear()
+        self.dump_thread = threading.Thread( target=self._dump, args=( period, logger ), name='Bus_Instrumentation' )
+        self.dump_thread.daemon = True
+        self.dump_thread.start()
+
+    def stop_dump(self):
+        if self.dump_thread is not None:
+            self.dump_stop.set()
+            self.dump_thread.join()
+            self.dump_thread = None
+
+    def _dump(self, period, logger):
+        while not self.dump_stop.wait( period ):
+            logger.info( 'Bus instrumentation %s', json.dumps( self.snapshot( reset=True ), sort_keys=True ) )
+
+
+class Bus_Transport(object):
+    ''' What USB2Dynamixel_Device needs from the bus - the subset of pyserial it uses.
+        timeout (seconds) and baudrate are attributes that can be changed at any time.
+        (A new-style class so that implementations can make them properties.)
+    '''
+    timeout = 1.0
+    baudrate = 57600
+
+    def write(self, msg):
+        raise NotImplementedError
+
+    def read(self, nBytes=1):
+        ''' returns up to nBytes, waiting no more than timeout for them
+        '''
+        raise NotImplementedError
+
+    def inWaiting(self):
+        raise NotImplementedError
+
+    def flushInput(self):
+        raise NotImplementedError
+
+    def flushOutput(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def fileno(self):
+        ''' fd that is readable while received bytes are waiting - only needed by reflex_async
+        '''
+        raise NotImplementedError
+
+
+class Serial_Transport(Bus_Transport):
+    ''' Bus_Transport on a pyserial port - the USB2Dynamixel adaptor
+    '''
+    def __init__(self, dev_name, baudrate, timeout=1.0):
+        self.port = None
+        try:
+            self.port = serial.Serial(dev_name, baudrate, timeout=timeout)
+            # Closing the device first seems to prevent "Access Denied" errors on WinXP
+            # (Conversations with Brian Wu @ MIT on 6/23/2010)
+            self.port.close()
+            self.port.setParity('N')
+            self.port.setStopbits(1)
+            self.port.open()
+
+            self.port.flushOutput()
+            self.port.flushInput()
+
+        except (serial.serialutil.SerialException), e:
+            print e.args
+            raise RuntimeError('lib_robotis: Serial port issue!\n')
+        if(self.port == None):
+            raise RuntimeError('lib_robotis: Serial port not found!\n')
+
+    def _get_timeout(self):
+        return self.port.timeout
+
+    def _set_timeout(self, timeout):
+        self.port.timeout = timeout
+
+    timeout = property(_get_timeout, _set_timeout)
+
+    def _get_baudrate(self):
+        return self.port.baudrate
+
+    def _set_baudrate(self, baudrate):
+        self.port.baudrate = baudrate
+
+    baudrate = property(_get_baudrate, _set_baudrate)
+
+    def write(self, msg):
+        self.port.write( msg )
+
+    def read(self, nBytes=1):
+        return self.port.read( nBytes )
+
+    def inWaiting(self):
+        return self.port.inWaiting()
+
+    def flushInput(self):
+        self.port.flushInput()
 
+    def flushOutput(self):
+        self.port.flushOutput()
+
+    def close(self):
+        self.port.close()
+
+    def fileno(self):
+        return self.port.fileno()
 
 
 class USB2Dynamixel_Device():
     ''' Class that manages serial port contention between servos on same bus
     '''
-    def __init__( self, dev_name = '/dev/ttyUSB0', baudrate = 57600 ):
+    def __init__( self, dev_name = '/dev/ttyUSB0', baudrate = 57600, transport = None ):
+        ''' transport - a Bus_Transport to use in place of the serial port dev_name (e.g. a simulated bus)
+        '''
         try:
             self.dev_name = string.atoi( dev_name ) # stores the serial port as 0-based integer for Windows
         except:
@@ -58,9 +862,18 @@ class USB2Dynamixel_Device():
 
         self.mutex = thread.allocate_lock()
         self.servo_dev = None
+        self.framer = Status_Packet_Framer()
+        self.encoder = Instruction_Packet_Encoder()
+        self.scheduler = None
+        self.instrumentation = None
+        self.baudrate = baudrate
 
         self.acq_mutex()
-        self._open_serial( baudrate )
+        if transport is None:
+            self._open_serial( baudrate )
+        else:
+            self.servo_dev = transport
+            self.servo_dev.baudrate = baudrate
         self.rel_mutex()
 
     def acq_mutex(self):
@@ -71,12 +884,232 @@ class USB2Dynamixel_Device():
 
     def write_serial(self, msg):
         # It is up to the caller to acquire / release mutex
+        # Replies are only expected to what we send next, anything still buffered is stale
+        if len(self.framer.buffer) > 0:
+            self.framer.drop_buffer()
         self.servo_dev.write( msg )
 
-    def read_serial(self, nBytes=1):
+    def read_serial(self, nBytes=1, timeout=None):
         # It is up to the caller to acquire / release mutex
-        rep = self.servo_dev.read( nBytes )
-        return rep
+        # timeout - seconds to wait for this read in place of the port's timeout
+        if timeout is None:
+            return self.servo_dev.read( nBytes )
+        blocking_timeout = self.servo_dev.timeout
+        self.servo_dev.timeout = timeout
+        try:
+            return self.servo_dev.read( nBytes )
+        finally:
+            self.servo_dev.timeout = blocking_timeout
+
+    def set_baudrate(self, baudrate):
+        ''' changes the adaptor's baud rate - the servos are changed with change_bus_baudrate
+        '''
+        self.acq_mutex()
+        try:
+            self.servo_dev.baudrate = baudrate
+            self.framer.drop_buffer()
+            self.servo_dev.flushInput()
+            self.baudrate = baudrate
+        finally:
+            self.rel_mutex()
+
+    def ping(self, servo_id, timeout=PING_TIMEOUT):
+        ''' True if servo_id answers a ping within timeout seconds at the current baud rate
+        '''
+        self.acq_mutex()
+        blocking_timeout = self.servo_dev.timeout
+        self.servo_dev.timeout = timeout
+        try:
+            self.write_serial( self.encoder.ping( servo_id ) )
+            self.receive_reply( servo_id )
+            return True
+        except RuntimeError:
+            return False
+        finally:
+            self.servo_dev.timeout = blocking_timeout
+            self.rel_mutex()
+
+    def scan(self, ids=range(1, 254), timeout=PING_TIMEOUT):
+        ''' returns the ids that answer a ping at the current baud rate
+        '''
+        return [ i for i in ids if self.ping( i, timeout ) ]
+
+    def start_scheduler(self, max_batch=16):
+        ''' scheduler mode - a Bus_Scheduler thread owns the serial port from now on
+        '''
+        if self.scheduler is None:
+            self.scheduler = Bus_Scheduler( self, max_batch )
+            self.scheduler.start()
+        return self.scheduler
+
+    def stop_scheduler(self):
+        if self.scheduler is not None:
+            scheduler = self.scheduler
+            self.scheduler = None
+            scheduler.stop()
+
+    def scheduler_stats(self):
+        if self.scheduler is None:
+            return None
+        return self.scheduler.stats()
+
+    def submit(self, priority, kind, packet, **kwargs):
+        ''' hands a request to the scheduler and returns its Bus_Future - see Bus_Request
+        '''
+        scheduler = self.scheduler
+        if scheduler is None:
+            raise RuntimeError('lib_robotis: Bus scheduler is not running\n')
+        return scheduler.submit( Bus_Request( priority, kind, packet, **kwargs ) )
+
+    def scheduled(self, priority, kind, packet, **kwargs):
+        ''' hands a request to the scheduler if there is one and returns its Bus_Future. Returns None if
+            there is none, or it has just been stopped - the caller then sends the packet itself.
+        '''
+        # read once - stop_scheduler may clear it from another thread at any time
+        scheduler = self.scheduler
+        if scheduler is None:
+            return None
+        return scheduler.try_submit( Bus_Request( priority, kind, packet, **kwargs ) )
+
+    def enable_instrumentation(self, dump_period=None):
+        ''' starts timing every transaction - returns the Bus_Instrumentation.
+            dump_period - if given, the figures are logged every dump_period seconds
+        '''
+        if self.instrumentation is None:
+            self.instrumentation = Bus_Instrumentation()
+        if dump_period is not None:
+            self.instrumentation.start_dump( dump_period )
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        if self.instrumentation is not None:
+            self.instrumentation.stop_dump()
+            self.instrumentation = None
+
+    def instrumentation_snapshot(self, reset=False):
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.snapshot( reset )
+
+    def transact(self, packet, reply_ids=(), started=None):
+        ''' sends packet and collects the status packets of reply_ids, in that order
+            started - time.time() when the caller began, so instrumentation can tell its overhead
+            returns {servo_id: ([n1,n2 ...], error)}
+        '''
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            return self._timed_transact( instrumentation, packet, reply_ids, started )
+        replies = {}
+        self.acq_mutex()
+        try:
+            self.write_serial( packet )
+            for servo_id in reply_ids:
+                replies[servo_id] = self.receive_reply( servo_id )
+        finally:
+            self.rel_mutex()
+        return replies
+
+    def _timed_transact(self, instrumentation, packet, reply_ids, started):
+        replies = {}
+        acquiring = time.time()
+        self.acq_mutex()
+        try:
+            locked = time.time()
+            self.write_serial( packet )
+            written = time.time()
+            for servo_id in reply_ids:
+                replies[servo_id] = self.receive_reply( servo_id )
+            replied = time.time()
+        finally:
+            self.rel_mutex()
+        errors = len([ r for r in replies.values() if r[1] != 0 ])
+        if errors > 0:
+            instrumentation.count( "error_bytes", errors )
+        instrumentation.record( packet, started or acquiring, acquiring, locked, written, replied, time.time() )
+        return replies
+
+    def sync_write(self, address, data, priority=GOAL):
+        ''' writes to the same control table address of several servos with one Sync Write (0x83) packet.
+            data = {servo_id: [n1,n2 ...]} - every servo must be given the same number of bytes.
+            The packet is sent to the broadcast id so the servos do not return a status packet.
+        '''
+        if len(data) == 0:
+            return
+        packet = self.encoder.sync_write( address, data )
+        future = self.scheduled( priority, 'packet', packet )
+        if future is not None:
+            future.result()
+        else:
+            self.transact( packet )
+
+    def bulk_read(self, requests, priority=READ):
+        ''' reads a block of the control table from several servos in one Bulk Read (0x92) transaction.
+            requests = [(servo_id, address, nBytes) ...]
+            returns {servo_id: [n1,n2 ...]}
+        '''
+        packet = self.encoder.bulk_read( requests )
+        # the servos answer one after the other in the order they are listed in the packet
+        reply_ids = [ r[0] for r in requests ]
+        future = self.scheduled( priority, 'packet', packet, reply_ids=reply_ids )
+        if future is not None:
+            replies = future.result()
+        else:
+            replies = self.transact( packet, reply_ids )
+        data = {}
+        for servo_id in reply_ids:
+            if replies[servo_id][1] != 0:
+                raise RuntimeError('lib_robotis: An error occurred: %d\n' % replies[servo_id][1])
+            data[servo_id] = replies[servo_id][0]
+        return data
+
+    def receive_reply(self, servo_id):
+        # It is up to the caller to acquire / release mutex
+        timeout = self.servo_dev.timeout
+        deadline = time.time() + timeout
+        while True:
+            packet = self.framer.next_packet()
+            if packet is not None:
+                reply_id, err, data = packet
+                if reply_id == servo_id:
+                    return data, err
+                # a late reply from another servo - skip it
+                self.framer.stray_packets += 1
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                # a reply may be waiting behind noise that looked like a header
+                if self.framer.resync():
+                    continue
+                self.framer.timeouts += 1
+                if self.instrumentation is not None:
+                    self.instrumentation.count( "timeouts" )
+                self.framer.drop_buffer()
+                self.servo_dev.flushInput()
+                raise RuntimeError('lib_robotis: Timed out waiting for a reply from servo %d\n' % servo_id)
+            # read everything that has arrived, but block for no more than what completes the packet
+            waiting = self.servo_dev.inWaiting()
+            needed = self.framer.bytes_needed()
+            n = max( waiting, needed )
+            framing = self.framer.framing()
+            # changing the port's timeout reconfigures the port, so it is only done when the read would block
+            # for longer than the reply can still take
+            if waiting >= needed:
+                wait = None # returns at once
+            elif framing:
+                # the rest of a packet that has started comes straight after it
+                wait = min( remaining, needed * 10.0 / self.baudrate + PACKET_GAP_TIMEOUT )
+            elif remaining < timeout - PACKET_GAP_TIMEOUT:
+                wait = remaining
+            else:
+                wait = None
+            data = self.read_serial( n, wait )
+            self.framer.feed( data )
+            if len(data) < n and framing:
+                # the line went quiet part way through - the header was noise
+                self.framer.resync()
+
+    def framing_stats(self):
+        return self.framer.stats()
 
     def _open_serial(self, baudrate):
 
@@ -97,33 +1130,19 @@ class USB2Dynamixel_Device():
         #
         # permission denied debugging
 
-        try:
-            self.servo_dev = serial.Serial(self.dev_name, baudrate, timeout=1.0)
-            # Closing the device first seems to prevent "Access Denied" errors on WinXP
-            # (Conversations with Brian Wu @ MIT on 6/23/2010)
-            self.servo_dev.close()
-            self.servo_dev.setParity('N')
-            self.servo_dev.setStopbits(1)
-            self.servo_dev.open()
-
-            self.servo_dev.flushOutput()
-            self.servo_dev.flushInput()
-
-        except (serial.serialutil.SerialException), e:
-            print e.args
-            raise RuntimeError('lib_robotis: Serial port issue!\n')
-        if(self.servo_dev == None):
-            raise RuntimeError('lib_robotis: Serial port not found!\n')
+        self.servo_dev = Serial_Transport( self.dev_name, baudrate )
 
 
 class Robotis_Servo():
     ''' Class to use a robotis MX-28
     '''
-    def __init__(self, USB2Dynamixel, servo_id, series = None ):
+    def __init__(self, USB2Dynamixel, servo_id, series = None, control_table = None ):
         ''' USB2Dynamixel - USB2Dynamixel_Device object to handle serial port.
                             Handles threadsafe operation for multiple servos
             servo_id - servo ids connected to USB2Dynamixel 1,2,3,4 ... (1 to 253)
                        [0 is broadcast if memory serves]
+            control_table - bytes already read from address 0 up (e.g. by a Bulk Read of several servos).
+                            They seed the shadow control table so the servo is not probed one read at a time.
         '''
         # not sure how I want to use the defaults yet - 28 Nov. 2015 - Rajan
         defaults = {
@@ -144,6 +1163,13 @@ class Robotis_Servo():
         else:
             self.dyn = USB2Dynamixel
 
+        # Shadow copy of the control table - {address: (value, time read or written)}
+        self.control_table = {}
+        # Assume the factory Status Return Level until it has been read from the servo
+        self.status_return_level = 2
+        if control_table is not None:
+            self.update_cache( 0x00, control_table )
+
         # ID exists on bus?
         self.servo_id = servo_id
         try:
@@ -156,6 +1182,11 @@ class Robotis_Servo():
         # Set Return Delay time - Used to determine when next status can be requested
         data = self.read_address( 0x05, 1)
         self.return_delay = data[0] * 2e-6
+        # Status Return Level - 0: reply to ping only, 1: reply to ping and read, 2: reply to everything
+        self.status_return_level = self.read_address( 0x10, 1 )[0]
+        # With no-ack writes, every verify_every-th write is read back so errors still surface (0 = never)
+        self.verify_every = 0
+        self.unverified_writes = 0
         # Set various parameters.  Load from servo_config.
         self.settings = {}
 
@@ -177,16 +1208,16 @@ class Robotis_Servo():
         data = self.read_address( 0x2e, 1 )
         return data[0] != 0
 
-    def read_voltage(self):
+    def read_voltage(self, max_age=None):
         ''' returns voltage (Volts)
         '''
-        data = self.read_address( 0x2a, 1 )
+        data = self.read_address( 0x2a, 1, max_age )
         return data[0] / 10.
 
-    def read_temperature(self):
+    def read_temperature(self, max_age=None):
         ''' returns the temperature (Celcius)
         '''
-        data = self.read_address( 0x2b, 1 )
+        data = self.read_address( 0x2b, 1, max_age )
         return data[0]
 
     def read_load(self):
@@ -304,6 +1335,13 @@ class Robotis_Servo():
         set_torque = data[0] + data[1] * 256
         return set_torque
 
+    def read_status_block(self):
+        ''' reads position, speed, load, voltage, temperature and the moving flag (0x24 to 0x2E)
+            in one instruction. returns the dictionary built by decode_status_block
+        '''
+        data = self.read_address( STATUS_BLOCK_ADDRESS, STATUS_BLOCK_LENGTH )
+        return decode_status_block( data )
+
     #end of Rajan's addition
 
     def read_angle(self):
@@ -331,6 +1369,8 @@ class Robotis_Servo():
             return
 
         self.set_angvel(angvel)
+        if blocking == True:
+            start = self.read_encoder()
 
         if self.settings['flipped']:
             ang = ang * -1.0
@@ -339,8 +1379,33 @@ class Robotis_Servo():
         self.move_to_encoder( enc_tics )
 
         if blocking == True:
-            while(self.is_moving()):
-                continue
+            self.wait_until_stopped( start, enc_tics )
+
+    def estimate_move_time(self, start, goal):
+        ''' seconds to move from encoder position start to goal at the moving speed (0x20)
+        '''
+        # the moving speed is written through write_address so the shadow copy is current
+        data = self.read_address( 0x20, 2, max_age=float('inf') )
+        speed = ( data[0] + data[1] * 256 ) & 0x3FF
+        if speed == 0:
+            rpm = MAX_RPM
+        else:
+            rpm = min( speed * RPM_PER_SPEED_UNIT, MAX_RPM )
+        ticks_per_rev = TICKS_PER_REV / max( self.read_address( 0x16, 1 )[0], 1 )
+        return abs( goal - start ) / ( rpm / 60.0 * ticks_per_rev )
+
+    def speed_for(self, ticks_per_second):
+        ''' moving speed (0x20) value that turns at least ticks_per_second - the inverse of estimate_move_time
+        '''
+        ticks_per_rev = TICKS_PER_REV / max( self.read_address( 0x16, 1 )[0], 1 )
+        rpm = abs( ticks_per_second ) * 60.0 / ticks_per_rev
+        return min( max( int( math.ceil( rpm / RPM_PER_SPEED_UNIT ) ), 1 ), 1023 )
+
+    def wait_until_stopped(self, start=None, goal=None, timeout=None):
+        ''' waits until the servo stops moving - see wait_for_motion.
+            returns True if it stopped before the timeout
+        '''
+        return self.servo_id in wait_for_motion( [( self, start, goal )], timeout )
 
     def move_to_encoder(self, n):
         ''' move to encoder position n
@@ -374,71 +1439,211 @@ class Robotis_Servo():
         '''
         return self.write_address( 0x03, [id] )
 
-    def __calc_checksum(self, msg):
-        chksum = 0
-        for m in msg:
-            chksum += m
-        chksum = ( ~chksum ) % 256
-        return chksum
+    def set_status_return_level(self, level):
+        ''' 0 - reply to ping only, 1 - reply to ping and read, 2 - reply to all instructions
+        '''
+        # Whether the servo answers this write depends on the old or new level, so don't wait for it
+        self.send_instruction( [ WRITE_DATA, 0x10, level ], self.servo_id, expect_reply=False )
+        self.dyn.acq_mutex()
+        try:
+            if level == 0:
+                time.sleep( 0.01 )
+                self.dyn.servo_dev.flushInput()
+            else:
+                # read the level back; an acknowledgement of the write (no parameters) may come first
+                self.dyn.write_serial( self.dyn.encoder.read( self.servo_id, 0x10, 1 ) )
+                data, err = self.dyn.receive_reply( self.servo_id )
+                if len(data) == 0:
+                    if self.dyn.instrumentation is not None:
+                        self.dyn.instrumentation.count( "retries" )
+                    data, err = self.dyn.receive_reply( self.servo_id )
+                if data != [ level ]:
+                    raise RuntimeError('lib_robotis: Status Return Level of servo %d not changed\n' % self.servo_id)
+        finally:
+            self.dyn.rel_mutex()
+        self.update_cache( 0x10, [ level ] )
+        self.status_return_level = level
+
+    def set_no_ack_writes(self, enable=True, verify_every=0):
+        ''' no-ack writes: the servo stops replying to writes (Status Return Level 1) and
+            write_address returns as soon as the packet is sent.
+            verify_every - read back every n-th write to surface errors (0 = never)
+        '''
+        if enable:
+            self.set_status_return_level( 1 )
+        else:
+            self.set_status_return_level( 2 )
+        self.verify_every = verify_every
+        self.unverified_writes = 0
 
-    def read_address(self, address, nBytes=1):
+    def expects_reply(self, command):
+        ''' True if the servo returns a status packet for the instruction command
+        '''
+        if command == PING:
+            return True
+        if command == READ_DATA:
+            return self.status_return_level >= 1
+        return self.status_return_level >= 2
+
+    def verify_write(self, address, data):
+        ''' reads back a write that was not acknowledged, once every verify_every writes
+        '''
+        if self.verify_every <= 0:
+            return
+        self.unverified_writes += 1
+        if self.unverified_writes < self.verify_every:
+            return
+        self.unverified_writes = 0
+        check = self.send_packet( self.dyn.encoder.read( self.servo_id, address, len(data) ), READ_DATA )
+        if check != list(data):
+            self.invalidate_cache( address, len(data) )
+            raise RuntimeError('lib_robotis: Write of %s at address 0x%x was not applied, read back %s\n'
+                               % ( data, address, check ))
+
+    def read_address(self, address, nBytes=1, max_age=None):
         ''' reads nBytes from address on the servo.
+            EEPROM values are served from the shadow control table once they have been read.
+            RAM values are served from it only if they are younger than max_age seconds.
             returns [n1,n2 ...] (list of parameters)
         '''
-        msg = [ 0x02, address, nBytes ]
-        return self.send_instruction( msg, self.servo_id )
+        if self.dyn.instrumentation is not None:
+            started = time.time()
+        else:
+            started = None
+        data = self.read_cache( address, nBytes, max_age )
+        if data is not None:
+            return data
+        packet = self.dyn.encoder.read( self.servo_id, address, nBytes )
+        future = None
+        if self.expects_reply( READ_DATA ):
+            future = self.dyn.scheduled( READ, 'read', packet, servo_id=self.servo_id, address=address,
+                                         nBytes=nBytes, reply_ids=[ self.servo_id ] )
+        if future is not None:
+            data = future.result()
+        else:
+            data = self.send_packet( packet, READ_DATA, started=started )
+        self.update_cache( address, data )
+        return data
 
     def write_address(self, address, data):
         ''' writes data at the address.
             data = [n1,n2 ...] list of numbers.
             return [n1,n2 ...] (list of return parameters)
         '''
-        msg = [ 0x03, address ] + data
-        return self.send_instruction( msg, self.servo_id )
-
-    def send_instruction(self, instruction, id):
-        msg = [ id, len(instruction) + 1 ] + instruction # instruction includes the command (1 byte + parameters. length = parameters+2)
-        chksum = self.__calc_checksum( msg )
-        msg = [ 0xff, 0xff ] + msg + [chksum]
-
-        self.dyn.acq_mutex()
+        if self.dyn.instrumentation is not None:
+            started = time.time()
+        else:
+            started = None
+        packet = self.dyn.encoder.write( self.servo_id, address, data )
         try:
-            self.send_serial( msg )
-            data, err = self.receive_reply()
+            if self.expects_reply( WRITE_DATA ):
+                reply_ids = [ self.servo_id ]
+            else:
+                reply_ids = []
+            future = self.dyn.scheduled( self.write_priority( address ), 'write', packet, servo_id=self.servo_id,
+                                         address=address, data=data, reply_ids=reply_ids )
+            if future is not None:
+                reply = future.result()
+            else:
+                reply = self.send_packet( packet, WRITE_DATA, started=started )
+            if not self.expects_reply( WRITE_DATA ):
+                self.verify_write( address, data )
         except:
-            self.dyn.rel_mutex()
+            self.invalidate_cache( address, len(data) )
             raise
-        self.dyn.rel_mutex()
+        self.update_cache( address, data )
+        return reply
+
+    def write_priority(self, address):
+        if address in SAFETY_ADDRESSES:
+            return SAFETY
+        return GOAL
+
+    def read_cache(self, address, nBytes=1, max_age=None):
+        ''' returns the shadow copy of nBytes from address or None if any of it is missing or stale
+        '''
+        now = time.time()
+        data = []
+        for a in range(address, address + nBytes):
+            entry = self.control_table.get(a)
+            if entry is None:
+                return None
+            if a >= EEPROM_SIZE and (max_age is None or now - entry[1] > max_age):
+                return None
+            data.append(entry[0])
+        return data
+
+    def update_cache(self, address, data):
+        now = time.time()
+        for i, v in enumerate(data):
+            self.control_table[address + i] = (v, now)
+
+    def invalidate_cache(self, address=None, nBytes=1):
+        ''' forgets nBytes from address, or the whole shadow control table if address is None
+        '''
+        if address is None:
+            self.control_table = {}
+            return
+        for a in range(address, address + nBytes):
+            self.control_table.pop(a, None)
+
+    def send_instruction(self, instruction, id, expect_reply=None):
+        ''' instruction = [command, n1, n2 ...]
+            expect_reply - None works it out from the instruction and the Status Return Level
+        '''
+        if expect_reply is None and id == BROADCAST_ID:
+            expect_reply = False
+        return self.send_packet( self.dyn.encoder.instruction( id, instruction ), instruction[0], expect_reply )
+
+    def send_packet(self, packet, command, expect_reply=None, started=None):
+        ''' sends a packet built by the encoder and returns the parameters of the reply
+            started - see USB2Dynamixel_Device.transact
+        '''
+        if expect_reply is None:
+            expect_reply = self.expects_reply( command )
+            if command == READ_DATA and not expect_reply:
+                raise RuntimeError('lib_robotis: Status Return Level 0 - servo %d does not reply to reads\n' % self.servo_id)
+
+        future = None
+        if self.dyn.scheduler is not None:
+            # scheduled checks again - the scheduler may be stopped in the meantime
+            if expect_reply:
+                reply_ids = [ self.servo_id ]
+            else:
+                reply_ids = []
+            future = self.dyn.scheduled( self.command_priority( command, packet ), 'packet', packet,
+                                         servo_id=self.servo_id, reply_ids=reply_ids )
+        if future is not None:
+            replies = future.result()
+            data, err = replies.get( self.servo_id, ( [], 0 ) )
+        elif expect_reply:
+            data, err = self.dyn.transact( packet, [ self.servo_id ], started )[self.servo_id]
+        else:
+            self.dyn.transact( packet, (), started )
+            data, err = [], 0
 
         if err != 0:
             self.process_err( err )
 
         return data
 
+    def command_priority(self, command, packet):
+        if command == WRITE_DATA:
+            return self.write_priority( ord(packet[5]) )
+        if command == READ_DATA or command == PING:
+            return READ
+        return GOAL
+
     def process_err( self, err ):
         raise RuntimeError('lib_robotis: An error occurred: %d\n' % err)
 
     def receive_reply(self):
-        start = self.dyn.read_serial( 2 )
-        if start != '\xff\xff':
-            raise RuntimeError('lib_robotis: Failed to receive start bytes\n')
-        servo_id = self.dyn.read_serial( 1 )
-        if ord(servo_id) != self.servo_id:
-            raise RuntimeError('lib_robotis: Incorrect servo ID received: %d\n' % ord(servo_id))
-        data_len = self.dyn.read_serial( 1 )
-        err = self.dyn.read_serial( 1 )
-        data = self.dyn.read_serial( ord(data_len) - 2 )
-        checksum = self.dyn.read_serial( 1 ) # I'm not going to check...
-        return [ord(v) for v in data], ord(err)
-
+        return self.dyn.receive_reply( self.servo_id )
 
     def send_serial(self, msg):
         """ sends the command to the servo
         """
-        out = ''
-        for m in msg:
-            out += chr(m)
-        self.dyn.write_serial( out )
+        self.dyn.write_serial( str(bytearray(msg)) )
 
 
 
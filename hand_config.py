@@ -0,0 +1,95 @@
+# module: hand_config.py
+# Snapshot of a Reflex_SF hand kept in a JSON file so the control process can restart in milliseconds:
+# the calibrated limits of the fingers, the EEPROM area of each servo's control table (baud rate, return
+# delay, limits, status return level, resolution ...) and a fingerprint of the hardware - baud rate, ids,
+# model numbers and firmware versions.
+# At start-up the servos are looked for at the snapshot's baud rate, so there is no baud rate discovery, and
+# their control tables are read with one Bulk Read. The EEPROM area read is checked against the snapshot -
+# the fingerprint and every EEPROM value, since a servo's EEPROM can be written (e.g. its status return level)
+# after the snapshot was saved - and the snapshot is written again if it differs.
+
+import json
+import os
+import time
+
+import dynamixel
+
+SNAPSHOT_VERSION = 1
+# seconds to wait for each servo during the check - a servo that has gone is not waited for as long as usual
+VERIFY_TIMEOUT = 0.05
+
+
+def fingerprint(baudrate, tables):
+    ''' tables = {servo_id: control table bytes from address 0}
+    '''
+    ids = sorted(tables.keys())
+    return {"baudrate": baudrate, "ids": ids,
+            "models": [tables[i][0] + tables[i][1] * 256 for i in ids],
+            "firmware": [tables[i][2] for i in ids]}
+
+
+def snapshot(palm):
+    ''' the snapshot of a reflex_sf hand as a dictionary that can be saved with save
+    '''
+    tables = {}
+    fingers = []
+    for f in palm.hand:
+        tables[f.id] = f.servo.read_address(0x00, dynamixel.EEPROM_SIZE)
+        fingers.append({"id": f.id, "lower_limit": f.lower_limit, "upper_limit": f.upper_limit,
+                        "rotation": f.rotation})
+    ids = sorted(tables.keys())
+    return {"version": SNAPSHOT_VERSION, "saved": time.strftime('%Y-%m-%d %H:%M:%S'),
+            "fingerprint": fingerprint(palm.dyn.baudrate, tables),
+            "eeprom": [tables[i] for i in ids], "fingers": fingers}
+
+
+def save(filename, data):
+    ''' writes the snapshot to a temporary file first so a crash never leaves half a snapshot behind
+    '''
+    temporary = filename + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(temporary, filename)
+
+
+def load(filename):
+    ''' returns the snapshot in filename, or None if there is none or it cannot be used
+    '''
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if data.get("version") != SNAPSHOT_VERSION:
+        return None
+    return data
+
+
+def calibration(data):
+    ''' {finger_id: {"lower_limit", "upper_limit", "rotation"}} of a snapshot
+    '''
+    return dict([(f["id"], f) for f in data["fingers"]])
+
+
+def verify(dyn, data, length=dynamixel.EEPROM_SIZE):
+    ''' reads the control tables of the snapshot's servos from address 0 up to length (at least the EEPROM
+        area) with one Bulk Read, at the snapshot's baud rate. The values read are what the hand is set up
+        from - the snapshot's copy of the EEPROM area is only compared with them, never used in their place.
+        returns (tables, match): tables = {servo_id: bytes read}, or None if the servos did not all answer;
+        match is True if the fingerprint and the EEPROM area are those of the snapshot.
+        Meant for start-up, before other threads use dyn.
+    '''
+    recorded = data["fingerprint"]
+    if dyn.baudrate != recorded["baudrate"]:
+        return None, False
+    blocking_timeout = dyn.servo_dev.timeout
+    dyn.servo_dev.timeout = VERIFY_TIMEOUT
+    try:
+        tables = dyn.bulk_read([(i, 0x00, length) for i in recorded["ids"]])
+    except RuntimeError:
+        return None, False
+    finally:
+        dyn.servo_dev.timeout = blocking_timeout
+    if fingerprint(dyn.baudrate, tables) != recorded:
+        return tables, False
+    return tables, [list(tables[i][:dynamixel.EEPROM_SIZE]) for i in recorded["ids"]] == data["eeprom"]
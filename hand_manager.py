@@ -0,0 +1,215 @@
+# module: hand_manager.py
+# Several Reflex_SF hands, each on its own USB2Dynamixel adapter, driven at the same time. Every hand has a
+# Hand_Worker thread that sets it up and then runs the commands given to it one after the other, so each bus
+# stays in order while the buses work in parallel (the threads spend their time waiting on the serial ports,
+# which releases the interpreter lock). Hand_Manager sends a command to all hands at once and collects the
+# results, and gathers the telemetry and bus statistics of every hand in one place.
+#
+#   python hand_manager.py --hands 4   - times gestures on simulated hands, one after the other and together
+
+import collections
+import optparse
+import Queue
+import threading
+import time
+
+import dynamixel
+import reflex_sf
+
+
+class Hand_Worker():
+    ''' Thread that owns one reflex_sf hand.
+        hand_args - keyword arguments of reflex_sf (usb_channel, baudrate, transport, config_file ...)
+    '''
+    def __init__(self, name, **hand_args):
+        self.name = name
+        self.hand_args = hand_args
+        self.palm = None
+        self.error = None # why the hand could not be set up
+        self.lock = threading.Lock()
+        self.requests = Queue.Queue()
+        self.ready = dynamixel.Bus_Future()
+        self.thread = threading.Thread(target=self._run, name='Hand_Worker ' + str(name))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, command, *args, **kwargs):
+        ''' runs palm.command(*args, **kwargs) on the worker thread - returns a dynamixel.Bus_Future
+            command may also be a function, which is called with the palm as its first argument
+            If the hand could not be set up, the future fails with the reason.
+        '''
+        future = dynamixel.Bus_Future()
+        with self.lock:
+            if self.error is not None:
+                future.set_exception(self.error)
+            else:
+                self.requests.put((future, command, args, kwargs))
+        return future
+
+    def stop(self):
+        ''' runs the commands already given, then closes the hand
+        '''
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        try:
+            self.palm = reflex_sf.reflex_sf(**self.hand_args)
+        except Exception, e:
+            with self.lock:
+                self.error = e
+                # commands given while the hand was being set up
+                while True:
+                    try:
+                        request = self.requests.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if request is not None:
+                        request[0].set_exception(e)
+            self.ready.set_exception(e)
+            return
+        self.ready.set_result(self.palm)
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            future, command, args, kwargs = request
+            try:
+                if callable(command):
+                    future.set_result(command(self.palm, *args, **kwargs))
+                else:
+                    future.set_result(getattr(self.palm, command)(*args, **kwargs))
+            except Exception, e:
+                future.set_exception(e)
+        self.palm.stop_telemetry()
+        self.palm.stop_recording()
+        self.palm.dyn.stop_scheduler()
+        self.palm.dyn.servo_dev.close()
+
+
+class Hand_Manager():
+    ''' hands = {name: keyword arguments of reflex_sf} - one entry per adapter.
+        The hands are set up in parallel; the manager is ready when they all are. If any hand fails, the
+        others are closed again and the RuntimeError of gather is raised.
+    '''
+    def __init__(self, hands, timeout=None):
+        self.workers = collections.OrderedDict()
+        for name in sorted(hands.keys()):
+            self.workers[name] = Hand_Worker(name, **hands[name])
+        try:
+            self.gather(dict([(name, w.ready) for name, w in self.workers.items()]), timeout)
+        except Exception:
+            self.stop()
+            raise
+
+    def names(self):
+        return self.workers.keys()
+
+    def hand(self, name):
+        return self.workers[name].palm
+
+    def submit(self, name, command, *args, **kwargs):
+        return self.workers[name].submit(command, *args, **kwargs)
+
+    def submit_all(self, command, *args, **kwargs):
+        ''' the same command to every hand - returns {name: Bus_Future}
+        '''
+        return dict([(name, w.submit(command, *args, **kwargs)) for name, w in self.workers.items()])
+
+    def gather(self, futures, timeout=None):
+        ''' waits for futures = {name: Bus_Future} and returns {name: result}.
+            Raises RuntimeError naming every hand that failed, once all have finished.
+        '''
+        results = {}
+        errors = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result(timeout)
+            except Exception, e:
+                errors[name] = e
+        if len(errors) > 0:
+            raise RuntimeError('hand_manager: Hands {} failed: {}\n'.format(sorted(errors.keys()), errors))
+        return results
+
+    def call_all(self, command, *args, **kwargs):
+        ''' runs command on all hands at once and returns {name: result}
+        '''
+        return self.gather(self.submit_all(command, *args, **kwargs))
+
+    def call_each(self, command, arguments):
+        ''' arguments = {name: (args tuple)} - command with different arguments per hand, e.g. a pose each
+        '''
+        return self.gather(dict([(name, self.submit(name, command, *arguments[name])) for name in arguments.keys()]))
+
+    def tighten_fingers(self):
+        return self.call_all('tighten_fingers')
+
+    def loosen_fingers(self):
+        return self.call_all('loosen_fingers')
+
+    def home(self, ids=(1,2,3,4)):
+        ''' {name: result of send_fingers_to_start_position}
+        '''
+        return self.call_all('send_fingers_to_start_position', ids)
+
+    def pose(self, poses, clamp=True, wait=False):
+        ''' poses = {name: pose} - see reflex_sf.move_hand_to
+        '''
+        return self.call_each('move_hand_to', dict([(name, (poses[name], clamp, None, wait))
+                                                    for name in poses.keys()]))
+
+    def hand_status(self):
+        return self.call_all('hand_status')
+
+    def start_telemetry(self, rates=None, size=1024):
+        self.call_all('start_telemetry', rates, size)
+
+    def telemetry(self, signal):
+        ''' {name: (time, values)} - the latest sample of signal from every hand, read from their ring buffers
+        '''
+        latest = {}
+        for name, w in self.workers.items():
+            if w.palm.telemetry is not None:
+                latest[name] = w.palm.telemetry.latest(signal)
+        return latest
+
+    def stats(self):
+        ''' {name: {"framing", "scheduler", "instrumentation", "telemetry"}} of every hand
+        '''
+        stats = {}
+        for name, w in self.workers.items():
+            dyn = w.palm.dyn
+            stats[name] = {"framing": dyn.framing_stats(), "scheduler": dyn.scheduler_stats(),
+                           "instrumentation": dyn.instrumentation_snapshot()}
+            if w.palm.telemetry is not None:
+                stats[name]["telemetry"] = w.palm.telemetry.stats()
+        return stats
+
+    def stop(self):
+        for w in self.workers.values():
+            w.stop()
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--hands', type='int', default=2, help='number of simulated hands [default: %default]')
+    parser.add_option('--baudrate', type='int', default=1000000, help='bus baud rate [default: %default]')
+    (options, args) = parser.parse_args()
+
+    import logging
+    import mx28_sim
+    logging.getLogger('MyLogger').addHandler(logging.NullHandler())
+    hands = dict([('hand{}'.format(k), {"usb_channel": 'simulated{}'.format(k), "baudrate": options.baudrate,
+                                         "transport": mx28_sim.reflex_sf_bus(options.baudrate)})
+                  for k in range(options.hands)])
+    manager = Hand_Manager(hands)
+    t = time.time()
+    for name in manager.names():
+        manager.submit(name, 'tighten_fingers').result()
+        manager.submit(name, 'loosen_fingers').result()
+    print 'One after the other: {:.3f} s'.format(time.time() - t)
+    t = time.time()
+    manager.tighten_fingers()
+    manager.loosen_fingers()
+    print 'Together: {:.3f} s'.format(time.time() - t)
+    manager.stop()
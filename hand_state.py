@@ -0,0 +1,96 @@
+# module: hand_state.py
+# State of the fingers of a Reflex_SF hand. Finger_State has fixed __slots__ in place of a dictionary, so
+# attribute access is fast and each finger takes little memory when several hands are run and their state is
+# snapshotted often. Hand_State holds the fingers zero-based (finger id 1 is fingers[0]) and gives NumPy
+# arrays of a field for all fingers at once.
+# For code written against the old dictionaries, finger["lower_limit"] still works and reads the slot.
+
+FIELDS = ("servo", "temperature", "resolution_divider", "initial_position", "goal_position", "multi_turn_offset",
+          "moving_speed", "direction", "lower_limit", "upper_limit", "rotation", "max_torque", "set_torque")
+# the fields that are numbers - see Hand_State.array and Hand_State.snapshot
+NUMERIC_FIELDS = FIELDS[1:]
+
+
+class Finger_State(object):
+    ''' One finger; id is the id of its servo
+    '''
+    __slots__ = ("id",) + FIELDS
+
+    def __init__(self, id, **fields):
+        self.id = id
+        for name in FIELDS:
+            setattr(self, name, fields.get(name))
+
+    def __getitem__(self, name):
+        if name not in FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in FIELDS:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def keys(self):
+        return list(FIELDS)
+
+    def as_dict(self):
+        return dict([(name, getattr(self, name)) for name in FIELDS])
+
+
+class Hand_State(object):
+    ''' The fingers of one hand in id order, indexed from 0
+    '''
+    __slots__ = ("fingers", "ids")
+
+    def __init__(self, fingers):
+        self.fingers = list(fingers)
+        self.ids = [f.id for f in self.fingers]
+
+    def __getitem__(self, index):
+        return self.fingers[index]
+
+    def __len__(self):
+        return len(self.fingers)
+
+    def __iter__(self):
+        return iter(self.fingers)
+
+    def by_id(self, id):
+        return self.fingers[self.ids.index(id)]
+
+    def array(self, name):
+        ''' NumPy array of a numeric field (e.g. "lower_limit") for every finger, in the order of fingers
+        '''
+        import numpy
+        return numpy.array([getattr(f, name) for f in self.fingers])
+
+    def positions(self):
+        ''' present positions (one Bulk Read) as a NumPy array in the order of fingers
+        '''
+        import numpy
+        servos = [f.servo for f in self.fingers]
+        blocks = servos[0].dyn.bulk_read([(s.servo_id, 0x24, 2) for s in servos])
+        return numpy.array([blocks[s.servo_id][0] + blocks[s.servo_id][1] * 256 for s in servos])
+
+    def limits(self):
+        ''' (lower_limit, upper_limit, rotation) arrays in the order of fingers
+        '''
+        return self.array("lower_limit"), self.array("upper_limit"), self.array("rotation")
+
+    def snapshot(self):
+        ''' the numeric fields of every finger as a NumPy structured array (one row per finger, with its id)
+        '''
+        import numpy
+        dtype = [("id", "i4")] + [(name, "f8") for name in NUMERIC_FIELDS]
+        rows = [tuple([f.id] + [_number(getattr(f, name)) for name in NUMERIC_FIELDS]) for f in self.fingers]
+        return numpy.array(rows, dtype=dtype)
+
+
+def _number(value):
+    # read_resolution_divider returns the list read from the servo
+    if isinstance(value, list):
+        value = value[0]
+    if value is None:
+        return float('nan')
+    return value
@@ -0,0 +1,149 @@
+# module: log_queue.py
+# Logging that stays off the thread driving the servos. Python 2.7 has no logging.handlers.QueueHandler, so
+# Queue_Handler puts log records on a queue and a Queue_Listener thread formats them and writes them to the
+# real handlers (e.g. the RotatingFileHandler). Messages are passed as a format string and arguments, e.g.
+#   my_logger.info('Finger%d - Moving From Position %d to Position %d', id, p, new_position)
+# and only formatted by the listener, so a disk stall, a log rotation or the formatting itself never delays a
+# finger command. If the listener falls behind by more than the queue size, records are dropped and counted.
+# Rate_Limit_Filter thins out messages that repeat - the same text, not just the same format string - faster than
+# a given rate.
+
+import logging
+import logging.handlers
+import Queue
+import threading
+
+QUEUE_SIZE = 10000
+# Rate_Limit_Filter forgets messages that have not repeated for a while once it holds this many
+MAX_BUCKETS = 1000
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+
+class Queue_Handler(logging.Handler):
+    ''' Puts log records on queue without formatting them.
+        The arguments are formatted later by the listener, so they should not be changed after the call
+        (numbers and strings as used in this code base are fine).
+    '''
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        if record.exc_info:
+            # the traceback cannot be formatted once the exception is gone
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+
+class Queue_Listener():
+    ''' Thread that hands the records from queue to handlers
+    '''
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='Queue_Listener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        ''' writes out what is already queued, then stops
+        '''
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+class Rate_Limit_Filter(logging.Filter):
+    ''' Lets through at most burst records of the same message (format string and arguments) at once, refilled
+        at rate records per second. The next record of that message let through says how many were held back.
+        Records that only share the format string, e.g. moves of different fingers, are not held back unless
+        their arguments cannot be a dictionary key.
+    '''
+    def __init__(self, rate=5.0, burst=10):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {} # (logger name, level, format string[, arguments]): [tokens, last time, suppressed]
+        self.forget_at = MAX_BUCKETS
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg, record.args)
+        try:
+            bucket = self.buckets.get(key)
+        except TypeError:
+            # arguments that cannot be a key (lists, dictionaries) are not turned into text on the caller's
+            # thread; those records share the limit of their format string
+            key = (record.name, record.levelno, record.msg)
+            bucket = self.buckets.get(key)
+        now = record.created
+        if bucket is None:
+            if len(self.buckets) >= self.forget_at:
+                self._forget(now)
+            bucket = [float(self.burst), now, 0]
+            self.buckets[key] = bucket
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1.0:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1.0
+        if bucket[2] > 0:
+            record.args = (record.getMessage(), bucket[2])
+            record.msg = '%s (%d similar messages suppressed)'
+            bucket[2] = 0
+        return True
+
+    def _forget(self, now):
+        # a message that has nothing held back and whose bucket has filled up again is as if never seen
+        full = self.burst / self.rate
+        for key in [k for k, b in self.buckets.items() if b[2] == 0 and now - b[1] >= full]:
+            del self.buckets[key]
+        # if most messages are recent, the next look is further off so that it stays cheap per record
+        self.forget_at = max(MAX_BUCKETS, 2 * len(self.buckets))
+
+
+def level_number(name):
+    ''' logging level of a name in LEVELS (case does not matter)
+    '''
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise ValueError('log_queue: Unknown log level {}'.format(name))
+    return level
+
+
+def start_file_logging(logger, filename, level=logging.DEBUG, rate=5.0, burst=10, max_bytes=2000000,
+                       backup_count=5):
+    ''' logs from logger to a rotating file through a Queue_Handler - returns the Queue_Listener to stop at exit
+        rate, burst - see Rate_Limit_Filter; rate None turns rate limiting off
+    '''
+    queue = Queue.Queue(QUEUE_SIZE)
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    queue_handler = Queue_Handler(queue)
+    if rate is not None:
+        queue_handler.addFilter(Rate_Limit_Filter(rate, burst))
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    listener = Queue_Listener(queue, handler)
+    listener.start()
+    return listener
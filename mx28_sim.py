@@ -0,0 +1,305 @@
+# module: mx28_sim.py
+# In-memory Dynamixel bus of simulated MX-28 servos, so that dynamixel.py and reflex_sf.py can be run, profiled
+# and load-tested without the hand. Simulated_Bus is a dynamixel.Bus_Transport: pass it to USB2Dynamixel_Device
+# (or reflex_sf) as transport.
+# Each servo keeps an MX-28 control table and moves its present position towards the goal at the moving speed.
+# Bytes take 10 bits on the wire at the bus baud rate, and a servo answers after its return delay, so replies
+# become readable when they would on the real bus.
+# fileno() gives a pipe that is readable while replies are waiting, as the fd of a serial port is, so the event
+# loop of reflex_async can run on the simulated bus in the same process.
+
+import os
+import threading
+import time
+
+import dynamixel
+
+CONTROL_TABLE_SIZE = 0x4a
+MODEL_NUMBER = 29 # MX-28
+FIRMWARE_VERSION = 36
+IDLE_TEMPERATURE = 35
+VOLTAGE = 120 # 12.0 V
+MOVING_LOAD = 100 # load reported while the servo is moving (0 to 1023)
+
+# Starting positions of the Reflex_SF servos 1 to 4 - at the calibrated lower limits in reflex_sf
+REFLEX_SF_POSITIONS = {1: 13900, 2: 16700, 3: 14050, 4: 16384}
+
+
+class Simulated_MX28():
+    ''' Control table and motion of one MX-28 in multi-turn mode
+    '''
+    def __init__(self, servo_id, position=2048, baudrate=57600):
+        t = bytearray(CONTROL_TABLE_SIZE)
+        t[0x00], t[0x01] = MODEL_NUMBER % 256, MODEL_NUMBER / 256
+        t[0x02] = FIRMWARE_VERSION
+        t[0x03] = servo_id
+        t[0x04] = dynamixel.BAUD_RATES[baudrate]
+        t[0x05] = 250 # return delay 500 us
+        t[0x06], t[0x07] = 0xff, 0x0f # CW and CCW angle limits of 4095 - multi-turn mode
+        t[0x08], t[0x09] = 0xff, 0x0f
+        t[0x0b] = 80 # temperature limit
+        t[0x0c], t[0x0d] = 60, 160 # voltage limits
+        t[0x0e], t[0x0f] = 0xff, 0x03 # max torque 1023
+        t[0x10] = 2 # status return level
+        t[0x11], t[0x12] = 36, 36 # alarm LED and shutdown
+        t[0x16] = 1 # resolution divider
+        t[0x1e], t[0x1f] = position % 256, position / 256
+        t[0x22], t[0x23] = 0xff, 0x03 # torque limit
+        t[0x24], t[0x25] = position % 256, position / 256
+        t[0x2a] = VOLTAGE
+        t[0x2b] = IDLE_TEMPERATURE
+        t[0x30], t[0x31] = 0x20, 0x00 # punch
+        self.table = t
+        self.position = float(position)
+        self.last_update = time.time()
+
+    def baud_code(self):
+        return self.table[0x04]
+
+    def return_delay(self):
+        return self.table[0x05] * 2e-6
+
+    def status_return_level(self):
+        return self.table[0x10]
+
+    def ticks_per_second(self):
+        t = self.table
+        speed = (t[0x20] + t[0x21] * 256) & 0x3FF
+        if speed == 0:
+            rpm = dynamixel.MAX_RPM
+        else:
+            rpm = min(speed * dynamixel.RPM_PER_SPEED_UNIT, dynamixel.MAX_RPM)
+        return rpm / 60.0 * dynamixel.TICKS_PER_REV / max(t[0x16], 1)
+
+    def update(self, now):
+        ''' moves the present position towards the goal for the time since the last update
+        '''
+        t = self.table
+        dt = now - self.last_update
+        self.last_update = now
+        goal = t[0x1e] + t[0x1f] * 256
+        step = self.ticks_per_second() * dt
+        if t[0x18] == 0 or abs(goal - self.position) <= step:
+            moving = t[0x18] != 0 and self.position != goal
+            direction = 0
+            if moving:
+                self.position = float(goal)
+        else:
+            moving = True
+            direction = 1 if goal > self.position else -1
+            self.position += direction * step
+        p = int(round(self.position))
+        t[0x24], t[0x25] = p % 256, p / 256
+        rpm = 0
+        load = 0
+        if moving and direction != 0:
+            rpm = int(round(self.ticks_per_second() * 60.0 / dynamixel.TICKS_PER_REV / dynamixel.RPM_PER_SPEED_UNIT))
+            load = MOVING_LOAD
+        cw = 0x400 if direction < 0 else 0
+        t[0x26], t[0x27] = (rpm | cw) % 256, (rpm | cw) / 256
+        t[0x28], t[0x29] = (load | cw) % 256, (load | cw) / 256
+        t[0x2e] = 1 if (moving and direction != 0) else 0
+
+    def read(self, address, nBytes, now):
+        self.update(now)
+        return list(self.table[address:address + nBytes])
+
+    def write(self, address, data, now):
+        self.update(now)
+        for i, v in enumerate(data):
+            if address + i < CONTROL_TABLE_SIZE:
+                self.table[address + i] = v
+        if address <= 0x1f and address + len(data) > 0x1e:
+            self.table[0x18] = 1 # a new goal position turns the torque on
+
+
+class Simulated_Bus(dynamixel.Bus_Transport):
+    ''' In-memory bus of Simulated_MX28 servos that behaves as the serial port of a USB2Dynamixel.
+        servos - {servo_id: Simulated_MX28}
+        model_timing - False makes replies readable at once (no byte or return delay times)
+    '''
+    def __init__(self, servos, baudrate=57600, timeout=1.0, model_timing=True):
+        self.servos = servos
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.model_timing = model_timing
+        self.rx = bytearray()
+        self.tx = bytearray() # bytes written that do not make a whole packet yet
+        self.pending = [] # [(time readable, bytes)] in time order
+        self.bus_free_at = 0.0
+        self.lock = threading.Lock()
+        self.instructions = 0
+        self.wakeup = None # (read fd, write fd) of the pipe given by fileno
+        self.signalled = False
+
+    def byte_time(self, nBytes):
+        if not self.model_timing:
+            return 0.0
+        return nBytes * 10.0 / self.baudrate
+
+    def _collect(self, now):
+        while len(self.pending) > 0 and self.pending[0][0] <= now:
+            self.rx.extend(self.pending.pop(0)[1])
+
+    def _listening(self, servo_id):
+        ''' servos only understand packets sent at the rate in their Baud Rate register
+        '''
+        servo = self.servos.get(servo_id)
+        if servo is None or dynamixel.BAUD_RATES.get(self.baudrate) != servo.baud_code():
+            return None
+        return servo
+
+    def _status(self, servo_id, err, data):
+        body = bytearray([servo_id, len(data) + 2, err]) + bytearray(data)
+        body.append((~sum(body)) % 256)
+        return bytearray('\xff\xff') + body
+
+    def write(self, msg):
+        with self.lock:
+            now = time.time()
+            t = max(now, self.bus_free_at) + self.byte_time(len(msg))
+            buf = self.tx
+            buf.extend(msg)
+            while len(buf) >= 6:
+                start = buf.find('\xff\xff')
+                if start < 0:
+                    del buf[:-1]
+                    break
+                del buf[:start]
+                if len(buf) < 4 or len(buf) < buf[3] + 4:
+                    break
+                length = buf[3]
+                packet = buf[:length + 4]
+                del buf[:length + 4]
+                if (~sum(packet[2:length + 3])) % 256 != packet[length + 3]:
+                    continue # servos ignore packets with a bad checksum
+                t = self._execute(packet[2], packet[4], list(packet[5:length + 3]), t)
+            self.bus_free_at = t
+
+    def _reply(self, servo, servo_id, data, t, command):
+        ''' queues a status packet if the Status Return Level asks for one; returns when the bus is free
+        '''
+        level = servo.status_return_level()
+        if command == dynamixel.PING or (command == dynamixel.READ_DATA and level >= 1) or level >= 2:
+            t += servo.return_delay()
+            reply = self._status(servo_id, 0, data)
+            t += self.byte_time(len(reply))
+            self.pending.append((t, reply))
+            if self.wakeup is not None:
+                timer = threading.Timer(max(t - time.time(), 0), self._signal)
+                timer.daemon = True
+                timer.start()
+        return t
+
+    def _execute(self, servo_id, command, params, t):
+        self.instructions += 1
+        if command == dynamixel.SYNC_WRITE:
+            address, nBytes = params[0], params[1]
+            for k in range(2, len(params), nBytes + 1):
+                servo = self._listening(params[k])
+                if servo is not None:
+                    servo.write(address, params[k + 1:k + 1 + nBytes], t)
+            return t
+        if command == dynamixel.BULK_READ:
+            for k in range(1, len(params), 3):
+                nBytes, target, address = params[k], params[k + 1], params[k + 2]
+                servo = self._listening(target)
+                if servo is not None:
+                    t = self._reply(servo, target, servo.read(address, nBytes, t), t, dynamixel.READ_DATA)
+            return t
+        if servo_id == dynamixel.BROADCAST_ID:
+            if command == dynamixel.WRITE_DATA:
+                for target in self.servos.keys():
+                    servo = self._listening(target)
+                    if servo is not None:
+                        servo.write(params[0], params[1:], t)
+            return t
+        servo = self._listening(servo_id)
+        if servo is None:
+            return t
+        if command == dynamixel.PING:
+            return self._reply(servo, servo_id, [], t, command)
+        if command == dynamixel.READ_DATA:
+            return self._reply(servo, servo_id, servo.read(params[0], params[1], t), t, command)
+        if command == dynamixel.WRITE_DATA:
+            servo.write(params[0], params[1:], t)
+            return self._reply(servo, servo_id, [], t, command)
+        return t
+
+    def read(self, nBytes=1):
+        deadline = time.time() + (self.timeout or 0)
+        while True:
+            with self.lock:
+                now = time.time()
+                self._collect(now)
+                if len(self.rx) >= nBytes or now >= deadline:
+                    data = str(self.rx[:nBytes])
+                    del self.rx[:nBytes]
+                    self._drain()
+                    return data
+                if len(self.pending) > 0:
+                    pause = min(self.pending[0][0], deadline) - now
+                else:
+                    pause = deadline - now
+            time.sleep(max(pause, 0))
+
+    def inWaiting(self):
+        with self.lock:
+            self._collect(time.time())
+            return len(self.rx)
+
+    def flushInput(self):
+        with self.lock:
+            self._collect(time.time())
+            del self.rx[:]
+            self._drain()
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        if self.wakeup is not None:
+            os.close(self.wakeup[0])
+            os.close(self.wakeup[1])
+            self.wakeup = None
+            self.signalled = False
+
+    def fileno(self):
+        ''' fd that is readable while received bytes are waiting - for an event loop's reader callback
+        '''
+        with self.lock:
+            if self.wakeup is None:
+                self.wakeup = os.pipe()
+                self._collect(time.time())
+                if len(self.rx) > 0:
+                    self._notify()
+            return self.wakeup[0]
+
+    def _signal(self):
+        # a reply has become readable
+        with self.lock:
+            if self.wakeup is not None:
+                self._collect(time.time())
+                if len(self.rx) > 0:
+                    self._notify()
+
+    def _notify(self):
+        # the lock is held
+        if not self.signalled:
+            os.write(self.wakeup[1], 'x')
+            self.signalled = True
+
+    def _drain(self):
+        # the lock is held; the pipe stops being readable once every received byte has been read
+        if self.signalled and len(self.rx) == 0:
+            os.read(self.wakeup[0], 1)
+            self.signalled = False
+
+
+def reflex_sf_bus(baudrate=57600, model_timing=True):
+    ''' Simulated_Bus with the four servos of a Reflex_SF hand at their start positions
+    '''
+    servos = {}
+    for i in REFLEX_SF_POSITIONS.keys():
+        servos[i] = Simulated_MX28(i, REFLEX_SF_POSITIONS[i], baudrate)
+    return Simulated_Bus(servos, baudrate, model_timing=model_timing)
@@ -0,0 +1,222 @@
+# module: recorder.py
+# Compact binary recording of the Reflex_SF hand - the goals commanded and the positions, loads and
+# temperatures read back - so that sessions can be analysed and replayed.
+# Every record has the same size (RECORD). Records are packed into a chunk in memory; full chunks go to a
+# background thread that appends them to the file, so recording never waits for the disk. If the disk falls
+# behind by more than MAX_PENDING_CHUNKS, chunks are dropped and counted rather than blocking the caller.
+# A session file is HEADER followed by the records. load() returns them as a NumPy record array.
+#
+#   python recorder.py session.rec            - summary of a session
+#   python recorder.py session.rec --replay   - replays its commands against simulated servos (or --device)
+
+import optparse
+import Queue
+import struct
+import threading
+import time
+
+MAGIC = 'RSF-REC\x01'
+# magic, record size
+HEADER = struct.Struct('<8sH6x')
+# time, goal, position, load, temperature, finger, source
+RECORD = struct.Struct('<diihBBBx')
+FIELDS = [('time', '<f8'), ('goal', '<i4'), ('position', '<i4'), ('load', '<i2'), ('temperature', 'u1'),
+          ('finger', 'u1'), ('source', 'u1'), ('pad', 'u1')]
+# Value of a field that was not known when the record was made (e.g. the position in a command record)
+MISSING = -1
+MISSING_LOAD = -32768
+MISSING_TEMPERATURE = 255
+
+# Where a record came from. "sample" records are read from the servos, the others are goals commanded.
+SOURCES = {"sample": 0, "api": 1, "joystick": 2, "replay": 3, "trajectory": 4}
+SOURCE_NAMES = dict([(v, k) for k, v in SOURCES.items()])
+
+CHUNK_RECORDS = 1024
+MAX_PENDING_CHUNKS = 64
+
+
+class Binary_Recorder():
+    ''' Appends fixed-size records to filename. Safe to call from several threads.
+    '''
+    def __init__(self, filename, chunk_records=CHUNK_RECORDS):
+        self.filename = filename
+        self.chunk_records = chunk_records
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(MAGIC, RECORD.size))
+        self.lock = threading.Lock()
+        self.chunk = bytearray(RECORD.size * chunk_records)
+        self.count = 0 # records in the current chunk
+        self.records = 0
+        self.dropped = 0
+        self.pending = Queue.Queue(MAX_PENDING_CHUNKS)
+        self.thread = threading.Thread(target=self._write, name='Binary_Recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, finger, source, goal=MISSING, position=MISSING, load=MISSING_LOAD,
+               temperature=MISSING_TEMPERATURE, t=None):
+        ''' source - a name in SOURCES
+        '''
+        if t is None:
+            t = time.time()
+        with self.lock:
+            RECORD.pack_into(self.chunk, self.count * RECORD.size, t, goal, position, load, temperature, finger,
+                             SOURCES[source])
+            self.count += 1
+            self.records += 1
+            if self.count == self.chunk_records:
+                self._hand_over()
+
+    def command(self, finger, goal, source="api", t=None):
+        self.record(finger, source, goal=goal, t=t)
+
+    def sample(self, finger, status, goal=MISSING):
+        ''' status - dictionary of dynamixel.decode_status_block
+        '''
+        # Counter Clockwise load is positive, Clockwise negative as in telemetry
+        load = status["raw_load"] & 0x3FF
+        if status["raw_load"] & 0x400:
+            load = -load
+        self.record(finger, "sample", goal, status["position"], load, status["temperature"])
+
+    def flush(self):
+        ''' hands the records so far to the writer thread
+        '''
+        with self.lock:
+            if self.count > 0:
+                self._hand_over()
+
+    def close(self):
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def stats(self):
+        return {"records": self.records, "dropped_records": self.dropped, "pending_chunks": self.pending.qsize()}
+
+    def _hand_over(self):
+        # called with self.lock held
+        try:
+            self.pending.put_nowait(str(self.chunk[:self.count * RECORD.size]))
+        except Queue.Full:
+            self.dropped += self.count
+        self.count = 0
+
+    def _write(self):
+        while True:
+            data = self.pending.get()
+            if data is None:
+                return
+            self.file.write(data)
+            self.file.flush()
+
+
+def load(filename):
+    ''' returns the records of a session as a NumPy record array with the fields of FIELDS
+    '''
+    import numpy
+    with open(filename, 'rb') as f:
+        magic, size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or size != RECORD.size:
+            raise RuntimeError('recorder: {} is not a session recording\n'.format(filename))
+        records = numpy.fromfile(f, dtype=numpy.dtype(FIELDS))
+    return records.view(numpy.recarray)
+
+
+def commands(records):
+    return records[records.source != SOURCES["sample"]]
+
+
+def samples(records):
+    return records[records.source == SOURCES["sample"]]
+
+
+def finger_track(records, finger, field="position"):
+    ''' (times, values) of one field of the samples of one finger
+    '''
+    s = samples(records)
+    s = s[s.finger == finger]
+    return s.time, getattr(s, field)
+
+
+def summary(records):
+    ''' {"records", "duration", "fingers": {finger: {"commands", "samples", "min_position", "max_position"}}}
+    '''
+    result = {"records": len(records), "duration": 0.0, "fingers": {}}
+    if len(records) == 0:
+        return result
+    result["duration"] = float(records.time.max() - records.time.min())
+    s = samples(records)
+    c = commands(records)
+    for finger in sorted(set(records.finger.tolist())):
+        positions = s.position[s.finger == finger]
+        entry = {"commands": int((c.finger == finger).sum()), "samples": len(positions)}
+        if len(positions) > 0:
+            entry["min_position"] = int(positions.min())
+            entry["max_position"] = int(positions.max())
+        result["fingers"][finger] = entry
+    return result
+
+
+def replay(records, palm, speed=1.0, wait=True):
+    ''' sends the commanded goals of a session to palm (a reflex_sf object), keeping their timing.
+        Goals recorded at the same time go out in one Sync Write.
+        speed - 2.0 replays twice as fast
+        wait - waits for the fingers to stop after the last command
+        returns the number of commands sent
+    '''
+    c = commands(records)
+    if len(c) == 0:
+        return 0
+    source = palm.command_source
+    palm.command_source = "replay"
+    try:
+        t0 = time.time()
+        first = c.time[0]
+        k = 0
+        last_goals = {}
+        while k < len(c):
+            t = c.time[k]
+            goals = {}
+            while k < len(c) and c.time[k] == t:
+                goals[int(c.finger[k])] = int(c.goal[k])
+                k += 1
+            pause = t0 + (t - first) / speed - time.time()
+            if pause > 0:
+                time.sleep(pause)
+            start = palm.hand_status(goals.keys())
+            palm.move_fingers_to(goals)
+            for i in goals.keys():
+                last_goals[i] = (start[i]["position"], goals[i])
+        if wait:
+            palm.wait_for_fingers(last_goals)
+    finally:
+        palm.command_source = source
+    return len(c)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options] session')
+    parser.add_option('--replay', action='store_true', default=False, help='replay the commands of the session')
+    parser.add_option('--device', help='serial port of the hand to replay against [default: simulated servos]')
+    parser.add_option('--speed', type='float', default=1.0, help='replay speed [default: %default]')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('one session file is needed')
+
+    records = load(args[0])
+    result = summary(records)
+    print 'Records: {}  Duration: {:.3f} s'.format(result["records"], result["duration"])
+    for finger, entry in sorted(result["fingers"].items()):
+        print 'Finger{}: {}'.format(finger, entry)
+    if options.replay:
+        import logging
+        import reflex_sf
+        logging.getLogger('MyLogger').addHandler(logging.NullHandler())
+        if options.device is None:
+            import mx28_sim
+            palm = reflex_sf.reflex_sf('simulated', 57600, mx28_sim.reflex_sf_bus())
+        else:
+            palm = reflex_sf.reflex_sf(options.device)
+        print 'Replayed {} commands'.format(replay(records, palm, options.speed))
@@ -0,0 +1,245 @@
+# module: reflex_async.py
+# Non-blocking front-end for the Reflex_SF hand so several hands and other I/O can share one event loop.
+# The code base is Python 2.7, so the event loop comes from trollius (the asyncio backport). Coroutines use
+# "yield From(...)" and "raise Return(...)" in place of "await" and "return".
+# The serial port is read from the loop's reader callback; replies are framed with the device's
+# Status_Packet_Framer and one lock per bus keeps the instructions in the order they were issued.
+#
+# Needs trollius (pip install trollius), which nothing else in the repository uses. trollius is deprecated and
+# no longer maintained upstream, so this module stays an optional front-end - the blocking reflex_sf does not
+# depend on it. The bus transport must have a pollable fileno(): the serial port of the USB2Dynamixel, or
+# mx28_sim.Simulated_Bus, whose pipe lets the event loop run on the simulated hand in the same process.
+
+import trollius as asyncio
+from trollius import From, Return
+
+import dynamixel
+import reflex_sf
+
+
+class Async_Dynamixel_Bus():
+    ''' Awaitable reads and writes on a USB2Dynamixel_Device.
+        Once wrapped, the device should only be used through this object.
+    '''
+    def __init__(self, device, loop=None, timeout=1.0):
+        self.device = device
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+        self.lock = asyncio.Lock(loop=self.loop)
+        self.expected = []  # servo ids whose status packets are awaited, in order
+        self.replies = {}
+        self.done = None
+        self.blocking_timeout = device.servo_dev.timeout
+        device.servo_dev.timeout = 0
+        self.loop.add_reader(device.servo_dev.fileno(), self._on_readable)
+
+    def close(self):
+        ''' hands the device back for blocking use
+        '''
+        self.loop.remove_reader(self.device.servo_dev.fileno())
+        self.device.servo_dev.timeout = self.blocking_timeout
+
+    def _on_readable(self):
+        dev = self.device.servo_dev
+        framer = self.device.framer
+        framer.feed(dev.read(max(dev.inWaiting(), 1)))
+        while True:
+            packet = framer.next_packet()
+            if packet is None:
+                return
+            servo_id, err, data = packet
+            if self.done is None or self.done.done() or len(self.expected) == 0 or servo_id != self.expected[0]:
+                framer.stray_packets += 1
+                continue
+            self.expected.pop(0)
+            if err != 0:
+                self.done.set_exception(RuntimeError('lib_robotis: An error occurred: %d\n' % err))
+                continue
+            self.replies[servo_id] = data
+            if len(self.expected) == 0:
+                self.done.set_result(self.replies)
+
+    @asyncio.coroutine
+    def transact(self, packet, reply_ids=()):
+        ''' sends packet and waits for the status packets of reply_ids, in that order
+            returns {servo_id: [n1,n2 ...]}
+        '''
+        with (yield From(self.lock)):
+            self.expected = list(reply_ids)
+            self.replies = {}
+            self.done = asyncio.Future(loop=self.loop)
+            self.device.write_serial(packet)
+            if len(self.expected) == 0:
+                self.done = None
+                raise Return({})
+            try:
+                replies = yield From(asyncio.wait_for(self.done, self.timeout, loop=self.loop))
+            except asyncio.TimeoutError:
+                self.device.framer.timeouts += 1
+                self.device.framer.drop_buffer()
+                raise RuntimeError('lib_robotis: Timed out waiting for a reply from servo %d\n' % self.expected[0])
+            finally:
+                self.expected = []
+                self.done = None
+            raise Return(replies)
+
+    @asyncio.coroutine
+    def read_address(self, servo, address, nBytes=1, max_age=None):
+        ''' servo - Robotis_Servo; its shadow control table is used as in Robotis_Servo.read_address
+        '''
+        data = servo.read_cache(address, nBytes, max_age)
+        if data is None:
+            packet = self.device.encoder.read(servo.servo_id, address, nBytes)
+            replies = yield From(self.transact(packet, [servo.servo_id]))
+            data = replies[servo.servo_id]
+            servo.update_cache(address, data)
+        raise Return(data)
+
+    @asyncio.coroutine
+    def write_address(self, servo, address, data):
+        if servo.expects_reply(dynamixel.WRITE_DATA):
+            reply_ids = [servo.servo_id]
+        else:
+            reply_ids = []
+        try:
+            yield From(self.transact(self.device.encoder.write(servo.servo_id, address, data), reply_ids))
+        except:
+            servo.invalidate_cache(address, len(data))
+            raise
+        servo.update_cache(address, data)
+
+    @asyncio.coroutine
+    def sync_write(self, address, data):
+        ''' data = {servo_id: [n1,n2 ...]} - see USB2Dynamixel_Device.sync_write
+        '''
+        if len(data) > 0:
+            yield From(self.transact(self.device.encoder.sync_write(address, data)))
+
+    @asyncio.coroutine
+    def bulk_read(self, requests):
+        ''' requests = [(servo_id, address, nBytes) ...] - see USB2Dynamixel_Device.bulk_read
+        '''
+        replies = yield From(self.transact(self.device.encoder.bulk_read(requests), [r[0] for r in requests]))
+        raise Return(replies)
+
+
+class Async_Reflex_SF():
+    ''' Awaitable finger moves and hand gestures for a reflex_sf object.
+        The hand is set up (blocking) by reflex_sf; after that all bus traffic goes through the event loop.
+    '''
+    def __init__(self, palm, loop=None):
+        self.palm = palm
+        self.finger = palm.finger
+        self.bus = Async_Dynamixel_Bus(palm.dyn, loop)
+        self.loop = self.bus.loop
+
+    def close(self):
+        self.bus.close()
+
+    @asyncio.coroutine
+    def hand_status(self, ids=(1,2,3,4)):
+        ''' {finger_id: status dictionary} with one Bulk Read - see reflex_sf.hand_status
+        '''
+        blocks = yield From(self.bus.bulk_read(
+            [(i, dynamixel.STATUS_BLOCK_ADDRESS, dynamixel.STATUS_BLOCK_LENGTH) for i in ids]))
+        status = {}
+        for i in ids:
+            status[i] = dynamixel.decode_status_block(blocks[i])
+        raise Return(status)
+
+    @asyncio.coroutine
+    def finger_positions(self, ids=(1,2,3,4)):
+        blocks = yield From(self.bus.bulk_read([(i, 0x24, 2) for i in ids]))
+        positions = {}
+        for i in ids:
+            positions[i] = blocks[i][0] + blocks[i][1] * 256
+        raise Return(positions)
+
+    @asyncio.coroutine
+    def wait_for_fingers(self, moves, timeout=None, tolerance=None):
+        ''' moves = {finger_id: (start_position, goal_position)}
+            Same dynamixel.Motion_Schedule as dynamixel.wait_for_motion but the loop is free while the fingers move.
+            returns {finger_id: seconds taken}; fingers that have not arrived by the timeout are left out
+        '''
+        schedule = dynamixel.Motion_Schedule(dict(
+            [(i, self.finger[i].servo.estimate_move_time(moves[i][0], moves[i][1])) for i in moves.keys()]), timeout)
+        while len(schedule.waiting()) > 0:
+            ready = schedule.ready()
+            if len(ready) > 0:
+                if tolerance is None:
+                    blocks = yield From(self.bus.bulk_read([(i, 0x2e, 1) for i in ready]))
+                    arrived = [i for i in ready if blocks[i][0] == 0]
+                else:
+                    positions = yield From(self.finger_positions(ready))
+                    arrived = [i for i in ready if abs(positions[i] - moves[i][1]) <= tolerance]
+                for i in arrived:
+                    schedule.arrived(i)
+                if len(schedule.waiting()) == 0:
+                    break
+            yield From(asyncio.sleep(schedule.pause(), loop=self.loop))
+        raise Return(schedule.arrival)
+
+    @asyncio.coroutine
+    def move_fingers_to(self, goals, speeds=None):
+        ''' see reflex_sf.move_fingers_to
+        '''
+        data = self.palm.goal_data(goals, speeds)
+        yield From(self.bus.sync_write(0x1e, data))
+        for i in data.keys():
+            self.finger[i].servo.update_cache(0x1e, data[i])
+        self.palm.record_goals(goals)
+
+    @asyncio.coroutine
+    def move_fingers_delta(self, ids, move_direction, increment):
+        ''' moves the fingers by increment and completes when they stop
+            returns {finger_id: position} after the move
+        '''
+        p = yield From(self.finger_positions(ids))
+        goals = {}
+        for i in ids:
+            new_position = p[i] + move_direction*self.finger[i].rotation*increment
+            if self.palm.is_finger_within_encoder_lower_limit(i, new_position) == 1:
+                goals[i] = new_position
+        if len(goals) > 0:
+            yield From(self.move_fingers_to(goals))
+            yield From(self.wait_for_fingers(dict([(i, (p[i], goals[i])) for i in goals.keys()])))
+            p = yield From(self.finger_positions(ids))
+        raise Return(p)
+
+    @asyncio.coroutine
+    def move_finger_delta(self, id, move_direction, increment):
+        p = yield From(self.move_fingers_delta([id], move_direction, increment))
+        raise Return(p[id])
+
+    @asyncio.coroutine
+    def tighten_fingers(self):
+        p = yield From(self.move_fingers_delta([1,2,3], 1, reflex_sf.DELTA_TICKS))
+        raise Return(p)
+
+    @asyncio.coroutine
+    def loosen_fingers(self):
+        p = yield From(self.move_fingers_delta([1,2,3], -1, reflex_sf.DELTA_TICKS))
+        raise Return(p)
+
+    @asyncio.coroutine
+    def spread_finger_1_and_2(self):
+        p = yield From(self.move_finger_delta(4, 1, reflex_sf.DELTA_TICKS))
+        raise Return(p)
+
+    @asyncio.coroutine
+    def close_finger_1_and_2(self):
+        p = yield From(self.move_finger_delta(4, -1, reflex_sf.DELTA_TICKS))
+        raise Return(p)
+
+    @asyncio.coroutine
+    def send_fingers_to_start_position(self, ids=(1,2,3,4), tolerance=None, timeout=None):
+        ''' see reflex_sf.send_fingers_to_start_position
+        '''
+        if tolerance is None:
+            tolerance = reflex_sf.HOME_TOLERANCE
+        start = yield From(self.finger_positions(ids))
+        goals = dict([(i, self.finger[i].lower_limit) for i in ids])
+        yield From(self.move_fingers_to(goals))
+        arrival = yield From(self.wait_for_fingers(dict([(i, (start[i], goals[i])) for i in ids]), timeout, tolerance))
+        p = yield From(self.finger_positions(ids))
+        raise Return(dict([(i, (p[i], arrival.get(i))) for i in ids]))
@@ -3,15 +3,19 @@ __author__ = 'srkiyengar'
 
 
 import dynamixel
+import hand_config
+import hand_state
+import log_queue
 import pygame
 import joystick
 from datetime import datetime
 import logging
-import logging.handlers
 
 import serial
 import time
 import thread
+import threading
+import Queue
 import sys, optparse
 import math
 import string
@@ -22,123 +26,455 @@ import grp
 
 DELTA_TICKS = 200
 CAL_TICKS = 100
-LOG_LEVEL = logging.DEBUG
+HOME_TOLERANCE = 20 # encoder ticks from lower_limit that count as being at the start position
+MOVING_SPEED = 150
+# The fast start reads the control table from 0x00 up to the present temperature (0x2B) in one Bulk Read
+INIT_TABLE_LENGTH = 0x2C
+LOG_LEVEL = 'DEBUG'
+LOG_RATE = 5.0
+# the joystick is read at INPUT_RATE and the screen drawn at DISPLAY_RATE (per second); commands run on their own
+INPUT_RATE = 100
+DISPLAY_RATE = 20
+CANCEL_BUTTON = 0 # the trigger stops the fingers where they are
+TELEMETRY_RATE = 10.0 # finger position and load samples per second for the display
 LOG_FILENAME = 'Reflex_SF_movement' + datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+# The handler is only attached when run as a program; the hand can also be used from other modules
+my_logger = logging.getLogger('MyLogger')
 
 class reflex_sf():
     '''The class manages the calibration and movement of the fingers for pinch and grasp
     '''
-    def __init__(self, usb_channel = '/dev/ttyUSB0', baudrate = 57600):
-        dyn = dynamixel.USB2Dynamixel_Device(usb_channel, baudrate)
+    def __init__(self, usb_channel = '/dev/ttyUSB0', baudrate = None, transport = None, fast_init = True,
+                 config_file = None):
+        # baudrate None - find the rate the servos are set to, trying the fastest first
+        # transport - e.g. mx28_sim.reflex_sf_bus() to run without the hand
+        # fast_init - ping all servos, read their control tables with one Bulk Read and set their speed with one
+        #             Sync Write; False sets up one servo at a time with a read per value
+        # config_file - snapshot of the calibration and servo configuration (see hand_config.py). The servos
+        #             are read at the snapshot's baud rate with one Bulk Read and no baud rate discovery; if
+        #             they differ from the snapshot, or there is no snapshot yet, the snapshot is written.
+        # The seconds spent in each phase are kept in self.init_timings
+        t0 = time.time()
+        self.init_timings = {}
+        self.config_file = config_file
+        config = None
+        if config_file is not None and fast_init:
+            config = hand_config.load(config_file)
+        if baudrate is None and config is not None:
+            dyn = dynamixel.USB2Dynamixel_Device(usb_channel, config["fingerprint"]["baudrate"], transport)
+        elif baudrate is None:
+            dyn = dynamixel.USB2Dynamixel_Device(usb_channel, dynamixel.BAUD_SEARCH_ORDER[0], transport)
+        else:
+            dyn = dynamixel.USB2Dynamixel_Device(usb_channel, baudrate, transport)
+        self.dyn = dyn
+        tables = None
+        save = False # the snapshot in config_file is to be written
+        if config is not None:
+            # one Bulk Read of the whole table, checked against the snapshot
+            tables, match = hand_config.verify(dyn, config, INIT_TABLE_LENGTH)
+            if tables is None:
+                my_logger.info('Hand not found as in the snapshot in %s - reading it again', config_file)
+            elif not match:
+                my_logger.info('Hand does not match the snapshot in %s - saving it again', config_file)
+                save = True
+            self.init_timings["verify"] = time.time() - t0
+        t = time.time()
+        if tables is None:
+            save = True
+            if baudrate is None:
+                found, ids = dynamixel.discover_bus(dyn, (1,2,3,4))
+                if found is None:
+                    raise RuntimeError('Servos 1 to 4 not found at any baud rate on', usb_channel, '\n')
+            elif fast_init:
+                missing = [i for i in (1,2,3,4) if not dyn.ping(i)]
+                if len(missing) > 0:
+                    raise RuntimeError('Servos {} not found on {}\n'.format(missing, usb_channel))
+            self.init_timings["discovery"] = time.time() - t
+            t = time.time()
+            if fast_init:
+                tables = dyn.bulk_read([(i, 0x00, INIT_TABLE_LENGTH) for i in (1,2,3,4)])
+                self.init_timings["state_read"] = time.time() - t
+        self.telemetry = None
+        self.recorder = None
+        self.command_source = "api" # recorded with the goals sent - see recorder.SOURCES
+        # set() ends the waits of the moves in progress so a newer command can take over - see Command_Dispatcher
+        self.cancel_motion = threading.Event()
         l_limits = [0,13900,16700,14050, 16384]
         max_movement = 2300 # change this a value that travel more that half way for the finger to grasp
         u_limits = [0,l_limits[1]+ max_movement ,l_limits[2]-max_movement,l_limits[3]+ max_movement ,l_limits[4]-max_movement]
+        calibration = {}
+        if config is not None:
+            # calibrated limits are kept even if the servos have changed
+            calibration = hand_config.calibration(config)
         self.finger = []
         self.finger.append(0) # finger starts with 1. Inserting 0 at the first list position
+        t = time.time()
         for i in range(1,5,1):
-            try:
-                # using the USB2Dynamixel object try to send commands to each and receive information
-                j= dynamixel.Robotis_Servo(dyn, i,"MX" )
-            except:
-                raise RuntimeError('Connection to Servo failure for servo number', i,'\n')
-            temp = j.read_temperature()
-            resol = j.read_resolution_divider()
-            current_pos = j.read_current_position()
-            goal_pos = j.get_goal_position()
-            offset = j.read_offset()
-            speed = 150
-            j.set_speed(speed)
+            if fast_init:
+                table = tables[i]
+                j = dynamixel.Robotis_Servo(dyn, i, "MX", control_table=table)
+                word = lambda address: table[address] + table[address + 1] * 256
+                temp = table[0x2b]
+                resol = [table[0x16]]
+                current_pos = word(0x24)
+                goal_pos = word(0x1e)
+                offset = word(0x14)
+                max_torque = word(0x0e)
+                set_torque = word(0x22)
+                speed = MOVING_SPEED
+            else:
+                try:
+                    # using the USB2Dynamixel object try to send commands to each and receive information
+                    j= dynamixel.Robotis_Servo(dyn, i,"MX" )
+                except:
+                    raise RuntimeError('Connection to Servo failure for servo number', i,'\n')
+                temp = j.read_temperature()
+                resol = j.read_resolution_divider()
+                current_pos = j.read_current_position()
+                goal_pos = j.get_goal_position()
+                offset = j.read_offset()
+                speed = MOVING_SPEED
+                j.set_speed(speed)
+                max_torque = j.read_max_torque()
+                set_torque = j.read_set_torque()
             if (i == 2 or i == 4):
                 joint_state = -1
                 u_limits[i] = l_limits[i] - max_movement
             else :
                 joint_state = 1
                 u_limits[i] = l_limits[i] + max_movement
-            max_torque = j.read_max_torque()
-            set_torque = j.read_set_torque()
-            finger_parameters = {"servo":j, "temperature": temp, "resolution_divider": resol, "initial_position": current_pos,
-                                 "goal_position":goal_pos,"multi_turn_offset":offset, "moving_speed":speed, "direction": 1,
-                                 "lower_limit":l_limits[i],"upper_limit":u_limits[i],"rotation":joint_state,
-                                 "max_torque":max_torque, "set_torque":set_torque}
+            if i in calibration:
+                l_limits[i] = calibration[i]["lower_limit"]
+                u_limits[i] = calibration[i]["upper_limit"]
+                joint_state = calibration[i]["rotation"]
+            finger_parameters = hand_state.Finger_State(i, servo=j, temperature=temp, resolution_divider=resol,
+                                 initial_position=current_pos, goal_position=goal_pos, multi_turn_offset=offset,
+                                 moving_speed=speed, direction=1, lower_limit=l_limits[i], upper_limit=u_limits[i],
+                                 rotation=joint_state, max_torque=max_torque, set_torque=set_torque)
             self.finger.append(finger_parameters)
+        # the same Finger_State objects indexed from 0, with array views - self.finger keeps the servo ids
+        self.hand = hand_state.Hand_State(self.finger[1:])
+        self.init_timings["servos"] = time.time() - t
+        if fast_init:
+            t = time.time()
+            speed = dict([(i, [MOVING_SPEED % 256, MOVING_SPEED / 256]) for i in range(1,5,1)])
+            dyn.sync_write(0x20, speed)
+            for i in range(1,5,1):
+                self.finger[i].servo.update_cache(0x20, speed[i])
+            self.init_timings["speed"] = time.time() - t
+        if config_file is not None and save:
+            self.save_config()
+        self.init_timings["total"] = time.time() - t0
+        my_logger.info('Reflex_SF set up in %.3f s - %s', self.init_timings["total"], self.init_timings)
 
 
     def is_finger_within_encoder_lower_limit(self, id, new_position):
-        p = self.finger[id]["lower_limit"]
-        rotation_mode = self.finger[id]["rotation"]
+        p = self.finger[id].lower_limit
+        rotation_mode = self.finger[id].rotation
         if rotation_mode == 1:
            if new_position < p:
-               my_logger.debug('Cannot exceed Finger{} start point {}'.format(id,p))
+               my_logger.debug('Cannot exceed Finger%s start point %s', id,p)
                return 0
            else:
                 return 1
         elif rotation_mode == -1:
            if new_position > p:
-               my_logger.debug('Cannot exceed Finger{} start point {}'.format(id,p))
+               my_logger.debug('Cannot exceed Finger%s start point %s', id,p)
                return 0
            else:
                 return 1
         else:
-            my_logger.debug('Finger{} - Rotation value {} not -1 or +1'.format(id,rotation_mode))
+            my_logger.debug('Finger%s - Rotation value %s not -1 or +1', id,rotation_mode)
             return 0
 
     def finger_current_position(self,id):
-        while (self.finger[id]["servo"].is_moving()):
-            pass
-        p = self.finger[id]["servo"].read_current_position()
-        my_logger.info('Finger{} - Current Position {}'.format(id,p))
+        servo = self.finger[id].servo
+        status = servo.read_status_block() # position and moving flag in one read
+        p = status["position"]
+        if self.recorder is not None:
+            self.recorder.sample(id, status, self.finger[id].goal_position)
+        if status["moving"]:
+            self.wait_for_fingers({id:(p, self.finger[id].goal_position)})
+            p = servo.read_current_position()
+        my_logger.info('Finger%s - Current Position %s', id,p)
         return p
 
+    def wait_for_fingers(self, moves, timeout=None):
+        '''waits for several fingers to stop moving; moves = {finger_id: (start_position, goal_position)}
+        returns {finger_id: seconds taken}; fingers that have not stopped by the timeout, or when
+        self.cancel_motion is set, are left out
+        '''
+        arrival = dynamixel.wait_for_motion([(self.finger[i].servo, moves[i][0], moves[i][1]) for i in moves.keys()],
+                                            timeout, self.cancel_motion)
+        for i in moves.keys():
+            if i not in arrival:
+                if self.cancel_motion.is_set():
+                    my_logger.info('Finger%s - Wait for Position %s cancelled', i,moves[i][1])
+                else:
+                    my_logger.info('Finger%s - Still moving towards Position %s after timeout', i,moves[i][1])
+        return arrival
+
+    def hand_status(self, ids=(1,2,3,4)):
+        '''position, speed, load, voltage, temperature and moving flag of the servos with one Bulk Read
+        returns {finger_id: status dictionary}
+        '''
+        blocks = self.dyn.bulk_read([(i, dynamixel.STATUS_BLOCK_ADDRESS, dynamixel.STATUS_BLOCK_LENGTH) for i in ids])
+        status = {}
+        for i in ids:
+            status[i] = dynamixel.decode_status_block(blocks[i])
+            if self.recorder is not None:
+                self.recorder.sample(i, status[i], self.finger[i].goal_position)
+        return status
+
+    def set_bus_baudrate(self, baudrate):
+        '''moves all four servos and the USB2Dynamixel to baudrate (e.g. 1000000) in one step
+        the servos keep the rate (EEPROM) so the next start finds the hand at it
+        '''
+        dynamixel.change_bus_baudrate(self.dyn, [1,2,3,4], baudrate)
+        for i in range(1,5,1):
+            self.finger[i].servo.update_cache(0x04, [dynamixel.BAUD_RATES[baudrate]])
+        my_logger.info('Bus changed to %s baud', baudrate)
+        if self.config_file is not None:
+            self.save_config()
+
+    def save_config(self, filename=None):
+        '''writes the calibrated limits, the EEPROM area of the servos and the hardware fingerprint to filename
+        (by default the config_file the hand was started with) for the next start - see hand_config.py
+        '''
+        if filename is None:
+            filename = self.config_file
+        hand_config.save(filename, hand_config.snapshot(self))
+        my_logger.info('Hand configuration saved in %s', filename)
+
+    def start_telemetry(self, rates=None, size=1024):
+        '''starts a background Telemetry_Sampler; rates = {signal: samples per second}, each above 0 (ValueError)
+        the latest values are then read from self.telemetry without going to the bus
+        '''
+        import telemetry # needs NumPy
+        if self.telemetry is None:
+            self.telemetry = telemetry.Telemetry_Sampler(self, rates, size)
+            self.telemetry.start()
+        return self.telemetry
+
+    def stop_telemetry(self):
+        if self.telemetry is not None:
+            self.telemetry.stop()
+            self.telemetry = None
+
+    def start_recording(self, filename):
+        '''records the goals sent and the status read from now on in the binary file filename - see recorder.py
+        '''
+        import recorder
+        self.stop_recording()
+        self.recorder = recorder.Binary_Recorder(filename)
+        return self.recorder
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def record_goals(self, goals):
+        if self.recorder is not None:
+            t = time.time() # goals sent together keep the same time so a replay sends them together
+            for i in goals.keys():
+                self.recorder.command(i, goals[i], self.command_source, t)
+
     def finger_load(self,id):
-        load, rotation = self.finger[id]["servo"].read_and_convert_raw_load()
+        load, rotation = self.finger[id].servo.read_and_convert_raw_load()
         return load, rotation
 
     def move_finger_delta(self, id, move_direction,increment): # direction +1 = finger closing; -1 = finger opening
         p = self.finger_current_position(id)
-        q = self.finger[id]["rotation"]
+        q = self.finger[id].rotation
         q = move_direction*q
         new_position = p + q*increment
         if self.is_finger_within_encoder_lower_limit(id,new_position) == 1:
-            my_logger.info('Finger{} - Moving From Position {} to Position {}'.format(id,p,new_position))
-            z = self.finger[id]["servo"].set_goal_position(new_position) # return data to make the program wait
-            #time.sleep(2) # temp - modify based on speed and tick to give time for the motor to move
+            my_logger.info('Finger%s - Moving From Position %s to Position %s', id,p,new_position)
+            z = self.finger[id].servo.set_goal_position(new_position) # return data to make the program wait
+            self.finger[id].goal_position = new_position
+            self.record_goals({id: new_position})
+            self.wait_for_fingers({id:(p, new_position)})
             p = self.finger_current_position(id)
         else:
-            my_logger.info('Outside Limit Finger{} - Move From Position {} to Position {}'.format(id,p,new_position))
+            my_logger.info('Outside Limit Finger%s - Move From Position %s to Position %s', id,p,new_position)
         return p
 
     def send_finger_to_start_position(self,id):
-        p = self.finger_current_position(id)
-        new_position = self.finger[id]["lower_limit"]
-        my_logger.info('Moving Finger{} From Position {} to Start Position {}'.format(id,p,new_position))
-        z = self.finger[id]["servo"].set_goal_position(new_position)
-        time.sleep(5) # temp - modify based on speed and tick to give time for the motor to move
-        p = self.finger_current_position(id)
+        return self.send_fingers_to_start_position([id])[id][0]
+
+    def send_fingers_to_start_position(self, ids=(1,2,3,4), tolerance=HOME_TOLERANCE, timeout=None):
+        '''moves the fingers to their lower_limit together and returns as each is within tolerance of it
+        returns {finger_id: (position, seconds taken)}; seconds taken is None if the finger did not get there
+        '''
+        status = self.hand_status(ids)
+        goals = {}
+        for i in ids:
+            goals[i] = self.finger[i].lower_limit
+            my_logger.info('Moving Finger%s From Position %s to Start Position %s', i,status[i]["position"],goals[i])
+        self.move_fingers_to(goals)
+        arrival = dynamixel.wait_for_motion([(self.finger[i].servo, status[i]["position"], goals[i]) for i in ids],
+                                            timeout, self.cancel_motion, tolerance)
+        result = {}
+        for i in ids:
+            p = self.finger[i].servo.read_current_position()
+            result[i] = (p, arrival.get(i))
+            if i in arrival:
+                my_logger.info('Finger%s - At Start Position %s after %.3f s', i,p,arrival[i])
+            else:
+                my_logger.info('Finger%s - Did not reach Start Position %s, at %s', i,goals[i],p)
+        return result
+
+    def move_fingers_to(self, goals, speeds=None):
+        '''sets goal position (and optionally moving speed) of any subset of servos 1-4 with one Sync Write packet
+        goals = {finger_id: goal_position}; speeds = {finger_id: moving_speed}
+        The servos do not reply to the broadcast packet so all fingers start moving together.
+        '''
+        data = self.goal_data(goals, speeds)
+        # Goal position (0x1E) and moving speed (0x20) are contiguous so both go in the same packet
+        self.dyn.sync_write(0x1e, data)
+        for i in data.keys():
+            self.finger[i].servo.update_cache(0x1e, data[i])
+        self.record_goals(goals)
+
+    def set_finger_speeds(self, speeds):
+        '''sets the moving speed of several servos with one Sync Write; speeds = {finger_id: moving_speed}
+        '''
+        data = dict([(i, [speeds[i] % 256, min(speeds[i] / 256, 3)]) for i in speeds.keys()])
+        self.dyn.sync_write(0x20, data)
+        for i in data.keys():
+            self.finger[i].servo.update_cache(0x20, data[i])
+            self.finger[i].moving_speed = speeds[i]
+
+    def goal_data(self, goals, speeds=None):
+        '''bytes to Sync Write at 0x1E for move_fingers_to; records the new goals and speeds in self.finger
+        '''
+        data = {}
+        for i in goals.keys():
+            n = goals[i]
+            if speeds is None:
+                data[i] = [n % 256, n / 256]
+            else:
+                s = speeds.get(i, self.finger[i].moving_speed)
+                data[i] = [n % 256, n / 256, s % 256, min(s / 256, 3)]
+                self.finger[i].moving_speed = s
+            self.finger[i].goal_position = n
+        return data
+
+    def stop_fingers(self, ids=(1,2,3,4)):
+        '''holds the fingers where they are now by making their present position the goal
+        returns {finger_id: position}
+        '''
+        p = self.finger_positions(ids)
+        self.move_fingers_to(p)
+        my_logger.info('Fingers %s stopped at %s', list(ids), p)
+        return p
+
+    def finger_positions(self, ids=(1,2,3,4)):
+        '''present positions of several fingers with one Bulk Read; returns {finger_id: position}
+        '''
+        blocks = self.dyn.bulk_read([(i, 0x24, 2) for i in ids])
+        return dict([(i, blocks[i][0] + blocks[i][1] * 256) for i in ids])
+
+    def limit_pose(self, pose, clamp=True):
+        '''checks pose = {finger_id: position} against the lower and upper limit of every finger at once
+        The positions are measured from lower_limit in the closing direction of each finger (rotation) so one
+        array comparison covers fingers that close with increasing and with decreasing encoder counts.
+        clamp - True brings positions outside the limits to the nearest limit
+        returns ({finger_id: position within limits}, [finger_ids that were outside])
+        '''
+        import numpy # only needed for whole-hand poses
+        ids = sorted(pose.keys())
+        target = numpy.array([pose[i] for i in ids])
+        index = [self.hand.ids.index(i) for i in ids]
+        lower, upper, rotation = [a[index] for a in self.hand.limits()]
+        travel = (upper - lower) * rotation
+        closing = (target - lower) * rotation
+        outside = (closing < 0) | (closing > travel)
+        if clamp:
+            target = lower + numpy.clip(closing, 0, travel) * rotation
+        limited = dict([(i, int(p)) for i, p in zip(ids, target)])
+        return limited, [i for i, out in zip(ids, outside) if out]
+
+    def move_hand_to(self, pose, clamp=True, speeds=None, wait=False):
+        '''moves any subset of the four fingers to pose = {finger_id: position} (or [p1, p2, p3, p4]) with one
+        Sync Write after checking the whole pose with limit_pose.
+        clamp - False refuses the pose (RuntimeError, nothing moves) if any finger is outside its limits
+        wait - waits for the fingers to stop
+        returns {finger_id: goal sent}
+        '''
+        if not isinstance(pose, dict):
+            pose = dict(zip(range(1, len(pose) + 1), pose))
+        goals, outside = self.limit_pose(pose, clamp)
+        if len(outside) > 0:
+            if not clamp:
+                raise RuntimeError('Fingers {} outside their limits in pose {}\n'.format(outside, pose))
+            my_logger.info('Hand pose %s - Fingers %s held at their limits', pose, outside)
+        if wait:
+            start = self.finger_positions(goals.keys())
+        self.move_fingers_to(goals, speeds)
+        if wait:
+            self.wait_for_fingers(dict([(i, (start[i], goals[i])) for i in goals.keys()]))
+        return goals
+
+    def move_hand_delta(self, deltas, clamp=True, wait=False):
+        '''moves fingers by deltas = {finger_id: ticks} (or [d1, d2, d3, d4]) from where they are, positive
+        ticks closing the finger as in move_finger_delta - see move_hand_to
+        '''
+        if not isinstance(deltas, dict):
+            deltas = dict(zip(range(1, len(deltas) + 1), deltas))
+        p = self.finger_positions(deltas.keys())
+        pose = dict([(i, p[i] + self.finger[i].rotation * deltas[i]) for i in deltas.keys()])
+        return self.move_hand_to(pose, clamp, wait=wait)
+
+    def move_fingers_delta(self, ids, move_direction, increment):
+        '''moves several fingers by increment in the same direction with one Sync Write
+        returns {finger_id: position} after the move
+        '''
+        goals = {}
+        p = {}
+        for i in ids:
+            p[i] = self.finger_current_position(i)
+            new_position = p[i] + move_direction*self.finger[i].rotation*increment
+            if self.is_finger_within_encoder_lower_limit(i,new_position) == 1:
+                my_logger.info('Finger%s - Moving From Position %s to Position %s', i,p[i],new_position)
+                goals[i] = new_position
+            else:
+                my_logger.info('Outside Limit Finger%s - Move From Position %s to Position %s', i,p[i],new_position)
+        if len(goals) > 0:
+            self.move_fingers_to(goals)
+            self.wait_for_fingers(dict([(i, (p[i], goals[i])) for i in goals.keys()]))
+            for i in goals.keys():
+                p[i] = self.finger_current_position(i)
         return p
 
     def tighten_fingers(self):
         how_much = DELTA_TICKS
         tighten = 1
-        for i in range(1,4,1): #1,2,3
-            my_logger.info('Finger{} - Before Tightening'.format(i))
+        ids = [1,2,3]
+        for i in ids:
+            my_logger.info('Finger%s - Before Tightening', i)
             load, rotation = self.finger_load(i)
-            my_logger.info('---> Load: {} Direction: {}'.format(load,rotation))
-            j = self.move_finger_delta(i,tighten,how_much)
-            my_logger.info('Finger{} - After tightening'.format(i))
+            my_logger.info('---> Load: %s Direction: %s', load,rotation)
+        j = self.move_fingers_delta(ids,tighten,how_much)
+        for i in ids:
+            my_logger.info('Finger%s - After tightening', i)
             load, rotation = self.finger_load(i)
-            my_logger.info('---> Load: {} Direction: {}'.format(load,rotation))
+            my_logger.info('---> Load: %s Direction: %s', load,rotation)
 
     def loosen_fingers(self):
         how_much = DELTA_TICKS
         tighten = -1    # loosen
-        for i in range(1,4,1): #1,2,3
-            my_logger.info('Finger{} - Before Loosening'.format(i))
+        ids = [1,2,3]
+        for i in ids:
+            my_logger.info('Finger%s - Before Loosening', i)
             load, rotation = self.finger_load(i)
-            my_logger.info('---> Load: {} Direction: {}'.format(load,rotation))
-            j = self.move_finger_delta(i,tighten,how_much)
-            my_logger.info('Finger{} - After Loosening'.format(i))
+            my_logger.info('---> Load: %s Direction: %s', load,rotation)
+        j = self.move_fingers_delta(ids,tighten,how_much)
+        for i in ids:
+            my_logger.info('Finger%s - After Loosening', i)
             load, rotation = self.finger_load(i)
-            my_logger.info('---> Load: {} Direction: {}'.format(load,rotation))
+            my_logger.info('---> Load: %s Direction: %s', load,rotation)
 
     def spread_finger_1_and_2(self):
         how_much = DELTA_TICKS
@@ -154,6 +490,77 @@ class reflex_sf():
         j = self.move_finger_delta(i,tighten,how_much)
         return j
 
+class Command_Dispatcher():
+    '''Runs hand commands one at a time in a worker thread so the joystick and the screen stay live during a move.
+    A new command supersedes the one still waiting to run and ends the wait of the one in progress (through
+    palm.cancel_motion); its goals then replace the old goals on the servos.
+    The display reads ("started" | "done" | "superseded" | "error", name, seconds or message) from self.status.
+    '''
+    def __init__(self, palm):
+        self.palm = palm
+        self.commands = Queue.Queue()
+        self.status = Queue.Queue()
+        self.running = None
+        self.superseded = 0
+        self.thread = threading.Thread(target=self._run, name='Command_Dispatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, name, command, *args):
+        '''runs command(*args) after the one in progress, which is told to stop waiting for its fingers
+        '''
+        self._drop_waiting()
+        if self.running is not None:
+            self.palm.cancel_motion.set()
+        self.commands.put((name, command, args))
+
+    def cancel(self):
+        '''drops the waiting command, ends the one in progress and holds the fingers where they are
+        '''
+        self.submit("Stop", self.palm.stop_fingers)
+
+    def stop(self):
+        '''lets the command in progress finish, then ends the thread
+        '''
+        self._drop_waiting()
+        self.commands.put(None)
+        self.thread.join()
+
+    def _drop_waiting(self):
+        while True:
+            try:
+                request = self.commands.get_nowait()
+            except Queue.Empty:
+                return
+            if request is None:
+                self.commands.put(None)
+                return
+            self.superseded += 1
+            self.status.put(("superseded", request[0], 0.0))
+
+    def _run(self):
+        while True:
+            request = self.commands.get()
+            if request is None:
+                return
+            name, command, args = request
+            # a cancel meant for the command before
+            self.palm.cancel_motion.clear()
+            self.running = name
+            self.status.put(("started", name, 0.0))
+            t = time.time()
+            try:
+                command(*args)
+                if self.palm.cancel_motion.is_set():
+                    self.superseded += 1
+                    self.status.put(("superseded", name, time.time() - t))
+                else:
+                    self.status.put(("done", name, time.time() - t))
+            except Exception, e:
+                my_logger.error('Command %s failed: %s', name, e)
+                self.status.put(("error", name, str(e)))
+            self.running = None
+
 # Define some colors
 BLACK    = (   0,   0,   0)
 WHITE    = ( 255, 255, 255)
@@ -161,15 +568,54 @@ WHITE    = ( 255, 255, 255)
 # This is a simple class that will help us print to the screen
 # It has nothing to do with the joysticks, just outputing the
 # information.
+# Each text is rendered once and its surface kept, and a line is only drawn again when its text has changed.
+# update() then puts just the changed lines on the window (dirty rectangles) rather than flipping all of it.
 class TextPrint:
+    CACHE_SIZE = 512 # rendered texts kept; the cache starts again when it is full
+
     def __init__(self):
         self.reset()
         self.font = pygame.font.Font(None, 20)
+        self.surfaces = {}  # text: rendered surface
+        self.lines = {}     # (x, y): (text, rectangle it covers on the screen)
+        self.dirty = []
+        self.renders = 0
 
     def Screenprint(self, screen, textString):
-        textBitmap = self.font.render(textString, True, BLACK)
-        screen.blit(textBitmap, [self.x, self.y])
+        position = (self.x, self.y)
         self.y += self.line_height
+        drawn = self.lines.get(position)
+        if drawn is not None and drawn[0] == textString:
+            return
+        textBitmap = self.surfaces.get(textString)
+        if textBitmap is None:
+            if len(self.surfaces) >= self.CACHE_SIZE:
+                self.surfaces.clear()
+            # rendered on the background colour so it covers the text that was there before
+            textBitmap = self.font.render(textString, True, BLACK, WHITE)
+            self.surfaces[textString] = textBitmap
+            self.renders += 1
+        rect = screen.blit(textBitmap, position)
+        if drawn is not None:
+            # the end of a longer text that was there before
+            old = drawn[1]
+            if old.right > rect.right:
+                screen.fill(WHITE, pygame.Rect(rect.right, old.top, old.right - rect.right, old.height))
+            rect = rect.union(old)
+        self.lines[position] = (textString, rect)
+        self.dirty.append(rect)
+
+    def update(self):
+        # puts the lines changed since the last update on the window
+        if len(self.dirty) > 0:
+            pygame.display.update(self.dirty)
+            self.dirty = []
+
+    def clear(self, screen):
+        # blanks the screen; every line is drawn again
+        screen.fill(WHITE)
+        self.lines = {}
+        self.dirty = [screen.get_rect()]
 
     def reset(self):
         self.x = 10
@@ -190,36 +636,58 @@ if __name__ == '__main__':
 
 
 
-    # Set up a logger with output level set to debug; Add the handler to the logger
-    my_logger = logging.getLogger('MyLogger')
-    my_logger.setLevel(LOG_LEVEL)
-    handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=2000000, backupCount=5)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    my_logger.addHandler(handler)
-    # end of logfile preparation Log levels are debug, info, warn, error, critical
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--log-level', default=LOG_LEVEL,
+                      choices=log_queue.LEVELS + [name.lower() for name in log_queue.LEVELS],
+                      help='one of ' + ', '.join(log_queue.LEVELS) + ' [default: %default]')
+    parser.add_option('--log-rate', type='float', default=LOG_RATE,
+                      help='most repeats of the same message logged per second, 0 for no limit [default: %default]')
+    parser.add_option('--headless', action='store_true', default=False,
+                      help='no window - the joystick still works and the commands are logged')
+    parser.add_option('--telemetry', type='float', default=TELEMETRY_RATE,
+                      help='finger position and load samples per second shown, 0 for none; not sampled with '
+                           '--headless [default: %default]')
+    (options, args) = parser.parse_args()
+
+    # Log records are queued and written to the rotating file by a background thread so that the disk
+    # never holds up a finger command. Log levels are debug, info, warn, error, critical
+    log_listener = log_queue.start_file_logging(my_logger, LOG_FILENAME, log_queue.level_number(options.log_level),
+                                                options.log_rate or None)
 
 
     palm = reflex_sf() # Reflex object ready
+    palm.command_source = "joystick"
 
     my_logger.info('Reflex_SF object created')
     for i in range(1,5,1):
-        lowest_position = palm.finger[i]["lower_limit"]
-        highest_position = palm.finger[i]["upper_limit"]
-        init_position = palm.finger[i]["initial_position"]
-        max_torque_setting = palm.finger[i]["max_torque"]
-        allowable_torque = palm.finger[i]["set_torque"]
-        my_logger.info('--- Finger {}:'.format(i))
-        my_logger.info('       Max Torque --- {}'.format(max_torque_setting))
-        my_logger.info('       Allowable Torque --- {}'.format(allowable_torque))
-        my_logger.info('       Lower Limit Position --- {}'.format(lowest_position))
-        my_logger.info('       Upper Limit Position --- {}'.format(highest_position))
-        my_logger.info('       Initial Position {}'.format(init_position))
-
+        lowest_position = palm.finger[i].lower_limit
+        highest_position = palm.finger[i].upper_limit
+        init_position = palm.finger[i].initial_position
+        max_torque_setting = palm.finger[i].max_torque
+        allowable_torque = palm.finger[i].set_torque
+        my_logger.info('--- Finger %s:', i)
+        my_logger.info('       Max Torque --- %s', max_torque_setting)
+        my_logger.info('       Allowable Torque --- %s', allowable_torque)
+        my_logger.info('       Lower Limit Position --- %s', lowest_position)
+        my_logger.info('       Upper Limit Position --- %s', highest_position)
+        my_logger.info('       Initial Position %s', init_position)
+
+    # only sampled for the display - without one it would be bus traffic for nothing
+    if options.telemetry > 0 and not options.headless:
+        try:
+            palm.start_telemetry({"position": options.telemetry, "load": options.telemetry})
+        except ImportError:
+            my_logger.warning('NumPy is not installed - no finger telemetry on the display')
+
+    if options.headless:
+        # pygame still needs a display for the joystick events, but it need not be a real one
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
     pygame.init()
 
     # Set the width and height of the screen [width,height]
     size = [500, 700]
+    if options.headless:
+        size = [1, 1]
     screen = pygame.display.set_mode(size)
 
     pygame.display.set_caption("Reflex_SF Commands")
@@ -229,6 +697,13 @@ if __name__ == '__main__':
 
     # Get ready to print
     textPrint = TextPrint()
+    textPrint.clear(screen)
+
+    # The loop below only reads the joystick and draws the screen; the hand commands run in the dispatcher's
+    # thread and report back through dispatcher.status
+    dispatcher = Command_Dispatcher(palm)
+    command_state = "Command: none"
+    next_frame = 0.0
 
     j_device = joystick.ExtremeProJoystick()
     # Get count of joystick
@@ -281,8 +756,7 @@ if __name__ == '__main__':
     # -------- Main Program Loop -----------
     while done==False:
         Button_Event = 0   #to check if pygame.event.get() encountered a button event
-        screen.fill(WHITE)
-        textPrint.reset()
+        Redraw = 0         #the whole window is drawn again once however many expose events came in
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                     done = True
@@ -347,36 +821,24 @@ if __name__ == '__main__':
                 i = event.dict['button']    # button number
                 Buttons[i] = 1
                 Button_Set[i] = 1
-                my_logger.debug("Button {} pressed".format(i))
+                my_logger.debug("Button %s pressed", i)
+                if i == CANCEL_BUTTON:
+                    my_logger.info("Button %s pressed - Stopping the fingers", i)
+                    dispatcher.cancel()
             elif event.type == pygame.JOYBUTTONUP:
                 Button_Event = 1
                 i = event.dict['button']
                 Buttons[i] = 0
-                my_logger.debug("Button {} released".format(i))
+                my_logger.debug("Button %s released", i)
             elif event.type == pygame.JOYHATMOTION:
                 Hat = event.dict['value']
-                my_logger.debug("Hat value: {}".format(str(Hat)))
+                my_logger.debug("Hat value: %s", Hat)
+            elif event.type == pygame.VIDEOEXPOSE or (event.type == pygame.ACTIVEEVENT and event.gain == 1):
+                Redraw = 1 # uncovered or restored - the unchanged lines are not in the dirty rectangles
             else:
                 pass # ignoring other event types
-
-        textPrint.Screenprint(screen, "Joystick name: {}".format(j_device.name))
-        textPrint.Yspace()
-        textPrint.Screenprint(screen, "Number of Axes: {}".format(Num_Axes))
-        textPrint.indent()
-        for i in range(Num_Axes):
-            textPrint.Screenprint(screen, "Axis {} value: {:>6.3f}".format(i, Axes[i]))
-        textPrint.unindent()
-        textPrint.Yspace()
-        textPrint.Screenprint(screen, "Number of Buttons: {}".format(Num_Buttons))
-        textPrint.indent()
-        for i in range(Num_Buttons):
-            textPrint.Screenprint(screen, "Button {:>2} value: {}".format(i,Buttons[i]))
-        textPrint.unindent()
-        textPrint.Yspace()
-        textPrint.Screenprint(screen, "Number of Hats: {}".format(Num_Hats) )
-        textPrint.indent()
-        textPrint.Screenprint(screen, "Hat value: {}".format(str(Hat)) )
-        textPrint.unindent()
+        if Redraw == 1 and not options.headless:
+            textPrint.clear(screen)
 
         #--------------------------------------------------------------------------------------------------
         #Processing Button events
@@ -387,93 +849,80 @@ if __name__ == '__main__':
                 finger_id = 1
                 direction = 1   #1 = tighten
                 increment = CAL_TICKS
-                palm.move_finger_delta(finger_id,direction,increment)
+                dispatcher.submit("Finger {} {}".format(finger_id, "tighten" if direction == 1 else "loosen"),
+                                  palm.move_finger_delta, finger_id, direction, increment)
 
             if (Button_Set[1] == 1 and Button_Set[6] == 1):
                 my_logger.info("Buttons 1 and 6 pressed")
                 finger_id = 1
                 direction = -1   #-1 = loosen
                 increment = CAL_TICKS
-                palm.move_finger_delta(finger_id,direction,increment)
+                dispatcher.submit("Finger {} {}".format(finger_id, "tighten" if direction == 1 else "loosen"),
+                                  palm.move_finger_delta, finger_id, direction, increment)
 
             if (Button_Set[2] == 1 and Button_Set[7] == 1):
                 my_logger.info("Buttons 2 and 7 pressed")
                 finger_id = 2
                 direction = 1   #1 = tighten
                 increment = CAL_TICKS
-                palm.move_finger_delta(finger_id,direction,increment)
+                dispatcher.submit("Finger {} {}".format(finger_id, "tighten" if direction == 1 else "loosen"),
+                                  palm.move_finger_delta, finger_id, direction, increment)
 
             if (Button_Set[2] == 1 and Button_Set[6] == 1):
                 my_logger.info("Buttons 2 and 6 pressed")
                 finger_id = 2
                 direction = -1   #-1 = loosen
                 increment = CAL_TICKS
-                palm.move_finger_delta(finger_id,direction,increment)
+                dispatcher.submit("Finger {} {}".format(finger_id, "tighten" if direction == 1 else "loosen"),
+                                  palm.move_finger_delta, finger_id, direction, increment)
 
             if (Button_Set[3] == 1 and Button_Set[7] == 1):
                 my_logger.info("Buttons 3 and 7 pressed")
                 finger_id = 3
                 direction = 1   #1 = tighten
                 increment = CAL_TICKS
-                palm.move_finger_delta(finger_id,direction,increment)
+                dispatcher.submit("Finger {} {}".format(finger_id, "tighten" if direction == 1 else "loosen"),
+                                  palm.move_finger_delta, finger_id, direction, increment)
 
             if (Button_Set[3] == 1 and Button_Set[6] == 1):
                 my_logger.info("Buttons 3 and 6 pressed")
                 finger_id = 3
                 direction = -1   #-1 = loosen
                 increment = CAL_TICKS
-                palm.move_finger_delta(finger_id,direction,increment)
+                dispatcher.submit("Finger {} {}".format(finger_id, "tighten" if direction == 1 else "loosen"),
+                                  palm.move_finger_delta, finger_id, direction, increment)
 
             if (Button_Set[4] == 1 and Button_Set[7] == 1):
                 my_logger.info("Buttons 4 and 7 pressed")
                 finger_id = 4
                 direction = 1   #1 = tighten
                 increment = CAL_TICKS
-                palm.move_finger_delta(finger_id,direction,increment)
+                dispatcher.submit("Finger {} {}".format(finger_id, "tighten" if direction == 1 else "loosen"),
+                                  palm.move_finger_delta, finger_id, direction, increment)
 
             if (Button_Set[4] == 1 and Button_Set[6] == 1):
                 my_logger.info("Buttons 4 and 6 pressed")
                 finger_id = 4
                 direction = -1   #-1 = loosen
                 increment = CAL_TICKS
-                palm.move_finger_delta(finger_id,direction,increment)
-
-            # Commands to send to Calibrated positions
-            if ((Button_Set[1] == 1) and (Button_Set[10] == 1)):
-                my_logger.info("Buttons 1 and 10 pressed - Sending Finger 1 to initial position")
-                finger_id = 1
-                palm.send_finger_to_start_position(finger_id)
-                Buttons[1] = 0
-                Buttons[10] = 0
-
-            if ((Button_Set[2] == 1) and (Button_Set[10] == 1)):
-                my_logger.info("Buttons 2 and 10 pressed - Sending Finger 2 to initial position")
-                finger_id = 2
-                palm.send_finger_to_start_position(finger_id)
-                # in case the buttonup event is not captured
-                Buttons[2] = 0
-                Buttons[10] = 0
-
-            if ((Button_Set[3] == 1) and (Button_Set[10] == 1)):
-                my_logger.info("Buttons 3 and 10 pressed - Sending Finger 3 to initial position")
-                finger_id = 3
-                palm.send_finger_to_start_position(finger_id)
-                # in case the buttonup event is not captured
-                Buttons[3] = 0
-                Buttons[10] = 0
-
-            if ((Button_Set[4] == 1) and (Button_Set[10] == 1)):
-                my_logger.info("Buttons 4 and 10 pressed - Sending Finger 4 to initial position")
-                finger_id = 4
-                palm.send_finger_to_start_position(finger_id)
-                # in case the buttonup event is not captured
-                Buttons[4] = 0
-                Buttons[10] = 0
+                dispatcher.submit("Finger {} {}".format(finger_id, "tighten" if direction == 1 else "loosen"),
+                                  palm.move_finger_delta, finger_id, direction, increment)
+
+            # Commands to send to Calibrated positions - all fingers pressed with button 10 are homed together
+            if Button_Set[10] == 1:
+                home_ids = [home_id for home_id in range(1,5,1) if Button_Set[home_id] == 1]
+                if len(home_ids) > 0:
+                    my_logger.info("Buttons %s and 10 pressed - Sending Fingers %s to initial position", home_ids,home_ids)
+                    dispatcher.submit("Home Fingers {}".format(home_ids), palm.send_fingers_to_start_position, home_ids)
+                    # in case the buttonup event is not captured
+                    for i in home_ids:
+                        Buttons[i] = 0
+                    Buttons[10] = 0
 
             for i in range(Num_Buttons):
                 if Buttons[i] == 0:
                     Button_Set[i] = 0
-                    #my_logger.info("Button {} Buttons {} and Button_Set {}".format(i,Buttons[i],Button_Set[i]))
+                    #my_logger.info("Button %s Buttons %s and Button_Set %s", i,Buttons[i],Button_Set[i])
 
         #--------------------------------------------------------------------------------------------------
         # end of Button event Processing
@@ -484,20 +933,20 @@ if __name__ == '__main__':
         if A3plus == True:
             if A1plus == True:
                 my_logger.info("Tighten Fingers - A3plus and A1plus True")
-                a = palm.tighten_fingers()
+                dispatcher.submit("Tighten Fingers", palm.tighten_fingers)
                 A1plus = False
             elif A1minus == True:
                 my_logger.info("Loosen Fingers - A3plus and A1minus True")
-                b = palm.loosen_fingers()
+                dispatcher.submit("Loosen Fingers", palm.loosen_fingers)
                 A1minus = False
         elif A3minus == True:
             if A0plus == True:
                 my_logger.info("Spread Finger 1 and 2 apart - A3minus and A0plus True")
-                h = palm.spread_finger_1_and_2()
+                dispatcher.submit("Spread Fingers 1 and 2", palm.spread_finger_1_and_2)
                 A0plus = False
             elif A0minus == True:
                 my_logger.info("Bring Finger 1 and 2 together - A3minus and A0minus True")
-                h = palm.close_finger_1_and_2()
+                dispatcher.submit("Close Fingers 1 and 2", palm.close_finger_1_and_2)
                 A0minus = False
         else:
             A0plus = False
@@ -515,18 +964,72 @@ if __name__ == '__main__':
         #A3plus = False #They are more like switch positions
         #A3minus = False #They are more like switch positions
         # end of reset flags
-    # ALL CODE TO DRAW SHOULD GO ABOVE THIS COMMENT
-
-    # Go ahead and update the screen with what we've drawn.
-        pygame.display.flip()
-
-    # Limit to 20 frames per second OR 50 ms scan rate - 1000/20 = 50 ms Both display and checking of Joystick;
-        clock.tick(20)
 
-# Close the window and quit.
-# If you forget this line, the program will 'hang' on exit if running from IDLE.
-
-pygame.quit ()
+        #--------------------------------------------------------------------------------------------------
+        # Display - the latest command state from the dispatcher, drawn at DISPLAY_RATE
+        #--------------------------------------------------------------------------------------------------
+        while True:
+            try:
+                state, name, value = dispatcher.status.get_nowait()
+            except Queue.Empty:
+                break
+            if state == "started":
+                command_state = "Command: {} running".format(name)
+            elif state == "error":
+                command_state = "Command: {} failed - {}".format(name, value)
+            else:
+                command_state = "Command: {} {} after {:.2f} s".format(name, state, value)
+            if options.headless:
+                my_logger.info(command_state)
+
+        if not options.headless and time.time() >= next_frame:
+            next_frame = time.time() + 1.0 / DISPLAY_RATE
+            textPrint.reset()
+            textPrint.Screenprint(screen, "Joystick name: {}".format(j_device.name))
+            textPrint.Yspace()
+            textPrint.Screenprint(screen, "Number of Axes: {}".format(Num_Axes))
+            textPrint.indent()
+            for i in range(Num_Axes):
+                textPrint.Screenprint(screen, "Axis {} value: {:>6.3f}".format(i, Axes[i]))
+            textPrint.unindent()
+            textPrint.Yspace()
+            textPrint.Screenprint(screen, "Number of Buttons: {}".format(Num_Buttons))
+            textPrint.indent()
+            for i in range(Num_Buttons):
+                textPrint.Screenprint(screen, "Button {:>2} value: {}".format(i,Buttons[i]))
+            textPrint.unindent()
+            textPrint.Yspace()
+            textPrint.Screenprint(screen, "Number of Hats: {}".format(Num_Hats) )
+            textPrint.indent()
+            textPrint.Screenprint(screen, "Hat value: {}".format(str(Hat)) )
+            textPrint.unindent()
+            textPrint.Yspace()
+            textPrint.Screenprint(screen, command_state)
+            if palm.telemetry is not None:
+                # from the telemetry ring buffers - the display does not use the bus
+                positions = palm.telemetry.latest("position")
+                loads = palm.telemetry.latest("load")
+                textPrint.Yspace()
+                for k, i in enumerate(palm.telemetry.ids):
+                    if positions is None or loads is None:
+                        textPrint.Screenprint(screen, "Finger {} position ----- load ----".format(i))
+                    else:
+                        textPrint.Screenprint(screen, "Finger {} position {:>5} load {:>4}".format(
+                            i, int(positions[1][k]), int(loads[1][k])))
+            # ALL CODE TO DRAW SHOULD GO ABOVE THIS COMMENT
+            # only the lines that changed go to the window
+            textPrint.update()
+
+    # The joystick is read every 1000/INPUT_RATE = 10 ms; the display and the hand commands do not hold it up
+        clock.tick(INPUT_RATE)
+
+    # Close the window and quit.
+    # If you forget this line, the program will 'hang' on exit if running from IDLE.
+
+    dispatcher.stop()
+    palm.stop_telemetry()
+    pygame.quit ()
+    log_listener.stop()
 
 
 
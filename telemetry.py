@@ -0,0 +1,183 @@
+# module: telemetry.py
+# Background sampling of the Reflex_SF servos. A thread polls each signal at its own rate with Bulk Reads and
+# keeps timestamped samples in fixed-size NumPy ring buffers. Readers take the latest value or a recent window
+# from the buffers without going to the serial bus.
+
+import threading
+import time
+
+import numpy
+
+import dynamixel
+
+
+def decode_position(data):
+    return data[0] + data[1] * 256
+
+def decode_load(data):
+    # Counter Clockwise load is positive, Clockwise negative
+    load = data[0] + data[1] * 256
+    if load & 0x400:
+        return -(load & 0x3FF)
+    return load & 0x3FF
+
+def decode_voltage(data):
+    return data[0] / 10.
+
+def decode_temperature(data):
+    return data[0]
+
+# signal: (address, nBytes, decoder)
+SIGNALS = {
+    "position": (0x24, 2, decode_position),
+    "load": (0x28, 2, decode_load),
+    "voltage": (0x2a, 1, decode_voltage),
+    "temperature": (0x2b, 1, decode_temperature),
+}
+
+# samples per second
+DEFAULT_RATES = {"position": 50.0, "load": 50.0, "voltage": 1.0, "temperature": 1.0}
+
+
+class Ring_Buffer():
+    ''' Fixed number of timestamped samples of one signal for several fingers.
+        There is one writer. count is only advanced after a slot has been filled so a reader never sees a
+        half written latest sample. A window can be overwritten if the reader takes longer than it takes the
+        writer to go round the whole buffer.
+    '''
+    def __init__(self, size, nFingers):
+        self.size = size
+        self.times = numpy.zeros(size)
+        self.values = numpy.zeros((size, nFingers))
+        self.count = 0
+
+    def append(self, t, values):
+        i = self.count % self.size
+        self.times[i] = t
+        self.values[i] = values
+        self.count += 1
+
+    def latest(self):
+        ''' returns (time, values) or None if nothing has been sampled
+        '''
+        n = self.count
+        if n == 0:
+            return None
+        i = (n - 1) % self.size
+        return self.times[i], self.values[i].copy()
+
+    def window(self, n=None, seconds=None):
+        ''' returns (times, values) of the last n samples, or of the samples of the last seconds, oldest first
+        '''
+        count = self.count
+        available = min(count, self.size)
+        if n is None:
+            n = available
+        n = min(n, available)
+        index = numpy.arange(count - n, count) % self.size
+        times = self.times[index]
+        values = self.values[index]
+        if seconds is not None and n > 0:
+            keep = times >= times[-1] - seconds
+            times, values = times[keep], values[keep]
+        return times, values
+
+    def achieved_rate(self):
+        times, values = self.window()
+        if len(times) < 2 or times[-1] == times[0]:
+            return 0.0
+        return (len(times) - 1) / (times[-1] - times[0])
+
+
+class Telemetry_Sampler():
+    ''' Polls the servos of a reflex_sf hand in a background thread.
+        rates = {signal: samples per second} for signals in SIGNALS
+        size - number of samples kept per signal
+    '''
+    def __init__(self, palm, rates=None, size=1024, ids=(1,2,3,4)):
+        self.palm = palm
+        self.ids = list(ids)
+        if rates is None:
+            rates = DEFAULT_RATES
+        self.rates = dict(rates)
+        self.buffers = {}
+        self.missed = {}
+        for signal in self.rates.keys():
+            if signal not in SIGNALS:
+                raise RuntimeError('telemetry: Unknown signal {}\n'.format(signal))
+            # checked here, on the caller's thread - the sampler thread divides by it
+            if not self.rates[signal] > 0:
+                raise ValueError('telemetry: Rate of {} must be above 0, not {}'.format(signal, self.rates[signal]))
+            self.buffers[signal] = Ring_Buffer(size, len(self.ids))
+            self.missed[signal] = 0
+        self.errors = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='Telemetry_Sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def latest(self, signal):
+        ''' returns (time, values) - values are in the order of self.ids
+        '''
+        return self.buffers[signal].latest()
+
+    def latest_finger(self, signal, id):
+        sample = self.buffers[signal].latest()
+        if sample is None:
+            return None
+        return sample[1][self.ids.index(id)]
+
+    def window(self, signal, n=None, seconds=None):
+        return self.buffers[signal].window(n, seconds)
+
+    def stats(self):
+        ''' {signal: {"rate", "achieved_rate", "missed", "samples"}} plus the number of bus errors
+        '''
+        stats = {"errors": self.errors}
+        for signal in self.buffers.keys():
+            stats[signal] = {"rate": self.rates[signal], "achieved_rate": self.buffers[signal].achieved_rate(),
+                             "missed": self.missed[signal], "samples": self.buffers[signal].count}
+        return stats
+
+    def _run(self):
+        next_due = {}
+        now = time.time()
+        for signal in self.buffers.keys():
+            next_due[signal] = now
+        while self.running:
+            now = time.time()
+            due = [s for s in next_due.keys() if next_due[s] <= now]
+            if len(due) == 0:
+                time.sleep(min(min(next_due.values()) - now, 0.1)) # wake up now and then to see if stopped
+                continue
+            for signal in due:
+                period = 1.0 / self.rates[signal]
+                late = int((now - next_due[signal]) / period)
+                if late > 0:
+                    self.missed[signal] += late
+                next_due[signal] += (late + 1) * period
+            try:
+                self._sample(due)
+            except RuntimeError:
+                self.errors += 1
+
+    def _sample(self, signals):
+        # one Bulk Read of the block covering every signal that is due
+        start = min([SIGNALS[s][0] for s in signals])
+        end = max([SIGNALS[s][0] + SIGNALS[s][1] for s in signals])
+        blocks = self.palm.dyn.bulk_read([(i, start, end - start) for i in self.ids], dynamixel.TELEMETRY)
+        t = time.time()
+        for signal in signals:
+            address, nBytes, decode = SIGNALS[signal]
+            offset = address - start
+            self.buffers[signal].append(t, [decode(blocks[i][offset:offset + nBytes]) for i in self.ids])
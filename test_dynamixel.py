@@ -0,0 +1,105 @@
+# module: test_dynamixel.py
+# Framing of status packets out of noisy bus data.
+#
+#   python -m unittest test_dynamixel
+
+import time
+import unittest
+
+import dynamixel
+
+
+def status_packet(servo_id, data, err=0):
+    body = bytearray([servo_id, len(data) + 2, err]) + bytearray(data)
+    body.append((~sum(body)) % 256)
+    return '\xff\xff' + str(body)
+
+
+class Scripted_Bus(dynamixel.Bus_Transport):
+    ''' Bus_Transport whose received bytes are set by the test; a read that cannot be filled waits for the
+        whole timeout, as a serial port does
+    '''
+    def __init__(self, received='', timeout=1.0):
+        self.rx = bytearray(received)
+        self.timeout = timeout
+
+    def write(self, msg):
+        pass
+
+    def read(self, nBytes=1):
+        if len(self.rx) < nBytes:
+            time.sleep(self.timeout)
+        data = str(self.rx[:nBytes])
+        del self.rx[:nBytes]
+        return data
+
+    def inWaiting(self):
+        return len(self.rx)
+
+    def flushInput(self):
+        del self.rx[:]
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Status_Packet_Framer_Test(unittest.TestCase):
+
+    def test_noise_before_packet(self):
+        framer = dynamixel.Status_Packet_Framer()
+        framer.feed('\x13\x00\xff\x42' + status_packet(1, [0x4c, 0x36]))
+        self.assertEqual(framer.next_packet(), (1, 0, [0x4c, 0x36]))
+        self.assertEqual(framer.stats()["discarded_bytes"], 4)
+
+    def test_bad_checksum_then_packet(self):
+        framer = dynamixel.Status_Packet_Framer()
+        bad = status_packet(2, [1, 2])[:-1] + '\x00'
+        framer.feed(bad + status_packet(2, [3, 4]))
+        self.assertEqual(framer.next_packet(), (2, 0, [3, 4]))
+        self.assertEqual(framer.stats()["checksum_errors"], 1)
+
+    def test_resync_after_long_header(self):
+        # noise that looks like the header of a 68 byte packet hides the reply behind it
+        framer = dynamixel.Status_Packet_Framer()
+        framer.feed('\xff\xff\x01\x40' + status_packet(1, [0x4c, 0x36]))
+        self.assertEqual(framer.next_packet(), None)
+        self.assertTrue(framer.resync())
+        self.assertEqual(framer.next_packet(), (1, 0, [0x4c, 0x36]))
+        self.assertFalse(framer.resync())
+
+    def test_packet_in_pieces(self):
+        framer = dynamixel.Status_Packet_Framer()
+        packet = status_packet(3, [5, 6, 7])
+        for k in range(len(packet) - 1):
+            framer.feed(packet[k])
+            self.assertEqual(framer.next_packet(), None)
+        framer.feed(packet[-1])
+        self.assertEqual(framer.next_packet(), (3, 0, [5, 6, 7]))
+
+
+class Receive_Reply_Test(unittest.TestCase):
+
+    def device(self, received, timeout=1.0):
+        return dynamixel.USB2Dynamixel_Device('scripted', 1000000, Scripted_Bus(received, timeout))
+
+    def test_reply_behind_noise(self):
+        dyn = self.device('\xff\xff\x01\x40' + status_packet(1, [0x4c, 0x36]))
+        t = time.time()
+        self.assertEqual(dyn.receive_reply(1), ([0x4c, 0x36], 0))
+        # the noise costs the packet gap, not the port timeout
+        self.assertTrue(time.time() - t < 0.5)
+        self.assertEqual(dyn.framing_stats()["resyncs"], 1)
+
+    def test_timeout_is_bounded(self):
+        dyn = self.device('\xff\xff\x01\x40', timeout=0.2)
+        t = time.time()
+        self.assertRaises(RuntimeError, dyn.receive_reply, 1)
+        self.assertTrue(time.time() - t < 0.3)
+        self.assertEqual(dyn.framing_stats()["timeouts"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
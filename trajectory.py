@@ -0,0 +1,211 @@
+# module: trajectory.py
+# Smooth, time-parameterised finger motion. Each finger follows a Finger_Trajectory through waypoints; the
+# Trajectory_Executor samples all of them at a fixed rate (50 to 100 Hz) and streams the goal positions with
+# one Sync Write per tick, with the moving speed set so that each servo keeps up with its profile rather
+# than jumping to every new goal at full speed. The executor reports how late each tick was sent (jitter)
+# and how many ticks ran over their period.
+
+import bisect
+import math
+import threading
+import time
+
+DEFAULT_RATE = 50.0
+# moving speed is set this much above the speed of the profile so the servo does not fall behind
+SPEED_MARGIN = 1.5
+MIN_TRACKING_SPEED = 50.0 # ticks per second
+
+
+class Finger_Trajectory():
+    ''' waypoints = [(time, position) or (time, position, velocity) ...] - seconds from the start, encoder
+        ticks and ticks per second. Missing velocities are taken from the neighbouring waypoints (zero at the
+        ends and where the finger turns back) and each segment is a cubic Hermite curve, so the position and
+        velocity are continuous and the finger never goes beyond a waypoint.
+    '''
+    def __init__(self, waypoints):
+        waypoints = sorted(waypoints)
+        if len(waypoints) == 0:
+            raise RuntimeError('trajectory: At least one waypoint is needed\n')
+        self.times = [float(w[0]) for w in waypoints]
+        self.positions = [float(w[1]) for w in waypoints]
+        n = len(waypoints)
+        self.velocities = []
+        for k in range(n):
+            if len(waypoints[k]) > 2:
+                v = float(waypoints[k][2])
+            elif k == 0 or k == n - 1:
+                v = 0.0
+            else:
+                before = self.positions[k] - self.positions[k - 1]
+                after = self.positions[k + 1] - self.positions[k]
+                if before * after <= 0:
+                    v = 0.0
+                else:
+                    v = (self.positions[k + 1] - self.positions[k - 1]) / (self.times[k + 1] - self.times[k - 1])
+            self.velocities.append(v)
+
+    def duration(self):
+        return self.times[-1]
+
+    def sample(self, t):
+        ''' (position, velocity) at t seconds; before the first and after the last waypoint the finger is held
+        '''
+        times = self.times
+        if t <= times[0]:
+            return self.positions[0], 0.0
+        if t >= times[-1]:
+            return self.positions[-1], 0.0
+        k = bisect.bisect_right(times, t) - 1
+        h = times[k + 1] - times[k]
+        s = (t - times[k]) / h
+        p0, p1 = self.positions[k], self.positions[k + 1]
+        m0, m1 = self.velocities[k] * h, self.velocities[k + 1] * h
+        s2 = s * s
+        s3 = s2 * s
+        position = (2*s3 - 3*s2 + 1) * p0 + (s3 - 2*s2 + s) * m0 + (-2*s3 + 3*s2) * p1 + (s3 - s2) * m1
+        velocity = ((6*s2 - 6*s) * p0 + (3*s2 - 4*s + 1) * m0 + (-6*s2 + 6*s) * p1 + (3*s2 - 2*s) * m1) / h
+        return position, velocity
+
+
+def ramp(start, goal, duration):
+    ''' Finger_Trajectory from start to goal in duration seconds, starting and ending at rest
+    '''
+    return Finger_Trajectory([(0.0, start, 0.0), (duration, goal, 0.0)])
+
+
+def timing_stats(samples):
+    ''' {"mean_us", "p99_us", "max_us"} of a list of seconds
+    '''
+    if len(samples) == 0:
+        return {"mean_us": 0.0, "p99_us": 0.0, "max_us": 0.0}
+    s = sorted(samples)
+    return {"mean_us": sum(s) / len(s) * 1e6, "p99_us": s[min(int(0.99 * len(s)), len(s) - 1)] * 1e6,
+            "max_us": s[-1] * 1e6}
+
+
+class Trajectory_Executor():
+    ''' Streams the goal positions of finger trajectories to a reflex_sf hand at rate ticks per second
+    '''
+    def __init__(self, palm, rate=DEFAULT_RATE, speed_margin=SPEED_MARGIN):
+        self.palm = palm
+        self.rate = rate
+        self.speed_margin = speed_margin
+        self.thread = None
+        self.cancel = threading.Event()
+        self.result = None
+
+    def run(self, trajectories, cancel=None):
+        ''' trajectories = {finger_id: Finger_Trajectory}; blocks until the longest one has been sent or cancel
+            (a threading.Event) is set, which holds the fingers where they are. Goals are kept between the
+            finger's lower and upper limits. The moving speeds of the fingers are put back at the end.
+            returns {"ticks", "cancelled", "overruns", "skipped_ticks", "rate", "achieved_rate", "duration",
+                     "jitter", "send"} - jitter is how late each tick was sent, send how long it took
+        '''
+        palm = self.palm
+        period = 1.0 / self.rate
+        end = max([trajectories[i].duration() for i in trajectories.keys()])
+        speeds = dict([(i, palm.finger[i].moving_speed) for i in trajectories.keys()])
+        bounds = {}
+        for i in trajectories.keys():
+            limits = (palm.finger[i].lower_limit, palm.finger[i].upper_limit)
+            bounds[i] = (min(limits), max(limits))
+        jitter = []
+        send = []
+        overruns = 0
+        skipped = 0
+        ticks = 0
+        cancelled = False
+        restored = False
+        source = palm.command_source
+        palm.command_source = "trajectory"
+        try:
+            t0 = time.time()
+            k = 0
+            while True:
+                deadline = t0 + k * period
+                pause = deadline - time.time()
+                if pause > 0:
+                    if cancel is None:
+                        time.sleep(pause)
+                    elif cancel.wait(pause):
+                        cancelled = True
+                        break
+                elif cancel is not None and cancel.is_set():
+                    cancelled = True
+                    break
+                sent = time.time()
+                jitter.append(sent - deadline)
+                t = sent - t0
+                goals = {}
+                tick_speeds = {}
+                for i in trajectories.keys():
+                    position, velocity = trajectories[i].sample(t)
+                    following, v = trajectories[i].sample(t + period)
+                    goals[i] = int(round(min(max(position, bounds[i][0]), bounds[i][1])))
+                    needed = max(abs(velocity), abs(following - position) * self.rate, MIN_TRACKING_SPEED)
+                    tick_speeds[i] = palm.finger[i].servo.speed_for(needed * self.speed_margin)
+                palm.move_fingers_to(goals, tick_speeds)
+                ticks += 1
+                send.append(time.time() - sent)
+                if t >= end:
+                    break
+                k += 1
+                late = int(math.floor((time.time() - t0 - k * period) / period))
+                if late >= 0:
+                    # this tick ran into the next one - the ticks already missed are not sent
+                    overruns += 1
+                    skipped += late
+                    k += late
+            if cancelled:
+                # stop where the fingers are rather than going on to the end of the trajectories
+                goals = palm.finger_positions(trajectories.keys())
+            else:
+                # the final goals
+                goals = {}
+                for i in trajectories.keys():
+                    position, velocity = trajectories[i].sample(end)
+                    goals[i] = int(round(min(max(position, bounds[i][0]), bounds[i][1])))
+            # at the usual moving speed
+            palm.move_fingers_to(goals, speeds)
+            restored = True
+        finally:
+            palm.command_source = source
+            if not restored:
+                try:
+                    palm.set_finger_speeds(speeds)
+                except RuntimeError:
+                    pass # the error on the way out is the one to report
+        duration = time.time() - t0
+        return {"ticks": ticks, "cancelled": cancelled, "overruns": overruns, "skipped_ticks": skipped, "rate": self.rate,
+                "achieved_rate": ticks / max(duration, period), "duration": duration,
+                "jitter": timing_stats(jitter), "send": timing_stats(send)}
+
+    def move_to(self, goals, duration, cancel=None):
+        ''' moves the fingers smoothly from where they are to goals = {finger_id: position} in duration seconds
+        '''
+        status = self.palm.hand_status(goals.keys())
+        return self.run(dict([(i, ramp(status[i]["position"], goals[i], duration)) for i in goals.keys()]), cancel)
+
+    def start(self, trajectories):
+        ''' runs the trajectories in a background thread - see wait and stop
+        '''
+        self.cancel.clear()
+        self.result = None
+        self.thread = threading.Thread(target=self._run, args=(trajectories,), name='Trajectory_Executor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self):
+        ''' waits for a trajectory started with start and returns what run returned
+        '''
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.result
+
+    def stop(self):
+        self.cancel.set()
+        return self.wait()
+
+    def _run(self, trajectories):
+        self.result = self.run(trajectories, self.cancel)